@@ -1,9 +1,10 @@
 import argparse
-import tensorflow as tf
+import lazy_loader
 import utils
 import data_reader
 import network_maker
 import network_helper
+tf = lazy_loader.lazy_import('tensorflow')
 
 
 def read_flag():
@@ -28,6 +29,12 @@ def read_flag():
                         help='decay learning rate at this number of steps')
     parser.add_argument('--decay-rate', default=DECAY_RATE, type=float,
                         help='decay learn rate by multiplying this factor')
+    parser.add_argument('--upsample-mode', default=UPSAMPLE_MODE, type=str, choices=utils.UPSAMPLE_MODES,
+                        help='upsampling block used in the model function')
+    parser.add_argument('--shared-dir', default=SHARED_DIR, type=str,
+                        help='attach to the data published in this directory by data_server.py')
+    parser.add_argument('--rand-seed', default=RAND_SEED, type=int,
+                        help='random seed of the data pipeline and of the model initialization')
 
     flags = parser.parse_args()
     return flags
@@ -42,14 +49,16 @@ def main(flags):
     reader = data_reader.DataReader(input_size=flags.input_size, output_size=output_size,
                                     x_range=flags.x_range, y_range=flags.y_range, cross_val=flags.cross_val,
                                     val_fold=flags.val_fold, batch_size=flags.batch_size,
-                                    shuffle_size=flags.shuffle_size)
+                                    shuffle_size=flags.shuffle_size, shared_dir=flags.shared_dir,
+                                    rand_seed=flags.rand_seed)
     features, labels, train_init_op, valid_init_op = reader.get_data_holder_and_init_op()
 
     # make network
     ntwk = network_maker.CnnNetwork(features, labels, utils.my_model_fn, flags.batch_size,
                                     fc_filters=flags.fc_filters, tconv_dims=flags.tconv_dims,
                                     tconv_filters=flags.tconv_filters, learn_rate=flags.learn_rate,
-                                    decay_step=flags.decay_step, decay_rate=flags.decay_rate)
+                                    decay_step=flags.decay_step, decay_rate=flags.decay_rate,
+                                    upsample_mode=flags.upsample_mode, seed=flags.rand_seed)
     # define hooks for monitoring training
     train_hook = network_helper.TrainValueHook(flags.verb_step, ntwk.loss,
                                                ckpt_dir=ntwk.ckpt_dir, write_summary=True)
@@ -80,6 +89,9 @@ if __name__ == '__main__':
         LEARN_RATE = 1e-3
         DECAY_STEP = 10000
         DECAY_RATE = 0.96
+        UPSAMPLE_MODE = 'tconv'
+        SHARED_DIR = None
+        RAND_SEED = 1234
 
         flags = read_flag()
         tf.reset_default_graph()
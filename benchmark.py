@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+import numpy as np
+import lazy_loader
+import utils
+import network_maker
+tf = lazy_loader.lazy_import('tensorflow')
+
+
+INPUT_SIZE = 2
+FC_FILTERS = (50, 100, 500, 50)
+TCONV_DIMS = (50, 150, 300)
+TCONV_FILTERS = (16, 8, 4)
+BATCH_SIZE = 20
+WARMUP_STEP = 10
+BENCH_STEP = 100
+STARTUP_RUN = 5
+CLI_SCRIPTS = ('train.py', 'evaluate.py', 'batch_plot.py', 'batch_train.py', 'search.py', 'serve.py')
+
+
+def read_flag():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-size', type=int, default=INPUT_SIZE, help='input size')
+    parser.add_argument('--fc-filters', type=tuple, default=FC_FILTERS, help='#neurons in each fully connected layers')
+    parser.add_argument('--tconv-dims', type=tuple, default=TCONV_DIMS,
+                        help='dimensionality of data after each transpose convolution')
+    parser.add_argument('--tconv-filters', type=tuple, default=TCONV_FILTERS,
+                        help='#filters at each transpose convolution')
+    parser.add_argument('--batch-size', default=BATCH_SIZE, type=int, help='batch size (100)')
+    parser.add_argument('--warmup-step', default=WARMUP_STEP, type=int, help='# steps to run before timing')
+    parser.add_argument('--bench-step', default=BENCH_STEP, type=int, help='# steps to time')
+    parser.add_argument('--gradient-checkpoint', action='store_true',
+                        help='recompute activations of the upsampling layers in the backward pass')
+    parser.add_argument('--startup', action='store_true', help='benchmark startup time of the CLI scripts instead')
+    parser.add_argument('--startup-run', default=STARTUP_RUN, type=int, help='# runs to average startup time over')
+
+    flags = parser.parse_args()
+    return flags
+
+
+def get_step_memory(run_metadata):
+    """
+    Sum up the bytes allocated for the outputs of every node in one traced step
+    :param run_metadata: tf.RunMetadata collected with a FULL_TRACE run
+    :return: #bytes allocated in the step
+    """
+    total_bytes = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for output in node_stats.output:
+                total_bytes += output.tensor_description.allocation_description.allocated_bytes
+    return total_bytes
+
+
+def benchmark_upsample(flags, model_fn, upsample_mode):
+    """
+    Time one training step and measure the memory allocated per batch for an upsampling block
+    :param flags: flags returned by read_flag()
+    :param model_fn: model function to benchmark
+    :param upsample_mode: upsampling block to use, one of utils.UPSAMPLE_MODES
+    :return: mean step time in seconds, #bytes allocated per batch
+    """
+    tf.reset_default_graph()
+    output_size = flags.tconv_dims[-1] if len(flags.tconv_dims) > 0 else flags.fc_filters[-1]
+    features = tf.random_uniform([flags.batch_size, flags.input_size])
+    labels = tf.random_uniform([flags.batch_size, output_size])
+    ntwk = network_maker.CnnNetwork(features, labels, model_fn, flags.batch_size,
+                                    fc_filters=flags.fc_filters, tconv_dims=flags.tconv_dims,
+                                    tconv_filters=flags.tconv_filters, make_folder=False,
+                                    upsample_mode=upsample_mode, gradient_checkpoint=flags.gradient_checkpoint)
+    with tf.Session() as sess:
+        sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+        for _ in range(flags.warmup_step):
+            sess.run(ntwk.optm)
+        start_time = time.time()
+        for _ in range(flags.bench_step):
+            sess.run(ntwk.optm)
+        step_time = (time.time() - start_time) / flags.bench_step
+
+        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        sess.run(ntwk.optm, options=run_options, run_metadata=run_metadata)
+    return step_time, get_step_memory(run_metadata)
+
+
+def benchmark_startup(script, run_num):
+    """
+    Time how long a CLI script takes to start, i.e. import its modules and parse its flags
+    :param script: name of the script
+    :param run_num: # runs to average over
+    :return: mean wall time in seconds
+    """
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script), '--help']
+    start_time = time.time()
+    for _ in range(run_num):
+        subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+    return (time.time() - start_time) / run_num
+
+
+def main(flags):
+    if flags.startup:
+        for script in CLI_SCRIPTS:
+            print('{:<16} startup time: {:.2f}ms'.format(script, benchmark_startup(script, flags.startup_run)*1e3))
+        return
+    for model_fn in [utils.my_model_fn, utils.my_model_fn_linear_conv1d]:
+        for upsample_mode in utils.UPSAMPLE_MODES:
+            step_time, step_bytes = benchmark_upsample(flags, model_fn, upsample_mode)
+            print('{:<26} {:<12} step time: {:.2f}ms, memory per batch: {:.2f}MB'.format(
+                model_fn.__name__, upsample_mode, step_time*1e3, step_bytes/np.power(2, 20)))
+
+
+if __name__ == '__main__':
+    flags = read_flag()
+    main(flags)
@@ -1,14 +1,49 @@
 import os
-import scipy.signal
-import sklearn.utils
+import json
+import zlib
 import numpy as np
-import tensorflow as tf
-from sklearn.model_selection import KFold
+import lazy_loader
+tf = lazy_loader.lazy_import('tensorflow')
+scipy_signal = lazy_loader.lazy_import('scipy.signal')
+scipy_spatial = lazy_loader.lazy_import('scipy.spatial')
+
+
+CROSS_VAL_FILE = 'UnitCellData_V7.txt'
+SHARED_RETRY = 3
+
+
+def savez_atomic(file, **arrays):
+    """
+    Save arrays into an npz file, the file is written under a temporary name and renamed so that processes reading it
+    concurrently never see a partially written file
+    :param file: full path to the npz file
+    :param arrays: arrays to save, see np.savez
+    :return:
+    """
+    tmp_file = '{}.{}.tmp.npz'.format(file[:-4], os.getpid())
+    np.savez(tmp_file, **arrays)
+    os.replace(tmp_file, file)
+
+
+def compute_norm_stats(ftr, lbl):
+    """
+    Compute mean and standard deviation of every feature and every label point
+    :param ftr: features
+    :param lbl: labels
+    :return: a dict of x_mean, x_std, y_mean and y_std, standard deviations of constant columns are set to 1
+    """
+    norm_stats = {'x_mean': np.mean(ftr, axis=0), 'x_std': np.std(ftr, axis=0),
+                  'y_mean': np.mean(lbl, axis=0), 'y_std': np.std(lbl, axis=0)}
+    for key in ('x_std', 'y_std'):
+        norm_stats[key][norm_stats[key] == 0] = 1
+    return norm_stats
 
 
 class DataReader(object):
     def __init__(self, input_size, output_size, x_range, y_range, cross_val=5, val_fold=0, batch_size=100,
-                 shuffle_size=100, data_dir=os.path.dirname(__file__), rand_seed=1234):
+                 shuffle_size=100, data_dir=os.path.dirname(__file__), rand_seed=1234, new_row_start=None,
+                 replay_ratio=0.5, error_index_file=None, hard_ratio=0.5, neighbor_num=5, shared_dir=None,
+                 normalize=False, norm_stats=None):
         """
         Initialize a data reader
         :param input_size: input size of the arrays
@@ -20,8 +55,27 @@ class DataReader(object):
         :param batch_size: size of the batch read every time
         :param shuffle_size: size of the batch when shuffle the dataset
         :param data_dir: parent directory of where the data is stored, by default it's the current directory
-        :param rand_seed: random seed
+        :param rand_seed: random seed of every shuffle and sampling of the reader, the same seed gives the same batches
+        :param new_row_start: if it's not none, rows of the training file before this index are considered old and
+                              training draws from the new rows mixed with replayed old rows
+        :param replay_ratio: fraction of replayed old rows in the training data when new_row_start is set
+        :param error_index_file: if it's not none, name of an error index written by evaluate.py in the data folder,
+                                 training rows are then sampled with higher probability where the model errs most,
+                                 it can not be combined with new_row_start
+        :param hard_ratio: fraction of the sampling probability assigned by error, the rest is uniform
+        :param neighbor_num: #nearest samples in the error index used to estimate the error of a training row
+        :param shared_dir: if it's not none, attach to the arrays published in this directory by data_server.py
+                           instead of loading the data files, all processes on the host then share one copy
+        :param normalize: if True, standardize features and labels in the input pipeline with the statistics of the
+                          training data
+        :param norm_stats: if it's not none, statistics used to normalize instead of the ones of the training data,
+                           e.g. the ones stored with a trained model, see get_norm_stats()
         """
+        if not 0 <= replay_ratio < 1:
+            raise ValueError('replay_ratio should be in [0, 1), got {}'.format(replay_ratio))
+        if new_row_start is not None and error_index_file is not None:
+            raise ValueError('error_index_file can not be combined with new_row_start, replayed rows are sampled '
+                             'uniformly')
         self.input_size = input_size
         self.output_size = output_size
         self.x_range = x_range
@@ -31,7 +85,196 @@ class DataReader(object):
         self.batch_size = batch_size
         self.shuffle_zie = shuffle_size
         self.data_dir = data_dir
-        np.random.seed(rand_seed)
+        self.new_row_start = new_row_start
+        self.replay_ratio = replay_ratio
+        self.error_index_file = error_index_file
+        self.hard_ratio = hard_ratio
+        self.neighbor_num = neighbor_num
+        self.sample_prob = None
+        self.shared_dir = shared_dir
+        self.rand_seed = rand_seed
+        self.shuffle_seed = rand_seed
+        self.rng = np.random.RandomState(rand_seed)
+        self.normalize = normalize or norm_stats is not None
+        self.norm_stats = norm_stats
+
+    def reset_rng(self, seed=None):
+        """
+        Reset the random state, the reader then produces the same batches as a new reader with rand_seed=seed
+        The cross validation folds are always split with rand_seed
+        :param seed: seed of the shuffles and sampling, default to rand_seed
+        :return:
+        """
+        self.shuffle_seed = self.rand_seed if seed is None else seed
+        self.rng = np.random.RandomState(self.shuffle_seed)
+
+    def get_shared_manifest(self, file_name, shared_dir):
+        """
+        Get name of the manifest data_server.py writes when it publishes the arrays of a data file, the manifest records
+        the size of the data file they were published from and the names of the array files
+        :param file_name: name of the data file in the data folder
+        :param shared_dir: directory of the published arrays
+        :return: manifest file
+        """
+        key = zlib.crc32('{} {} {}'.format(list(self.x_range), list(self.y_range), self.output_size).encode())
+        return os.path.join(shared_dir, 'dlm_{}.{:08x}.json'.format(file_name, key))
+
+    def get_shared_files(self, file_name, shared_dir, file_size):
+        """
+        Get names of the files where data_server.py publishes the arrays of a data file, every version of the data file
+        is published under its own names
+        :param file_name: name of the data file in the data folder
+        :param shared_dir: directory of the published arrays
+        :param file_size: size of the data file the arrays are published from
+        :return: feature file and label file
+        """
+        prefix = '{}.{}'.format(self.get_shared_manifest(file_name, shared_dir)[:-len('.json')], file_size)
+        return prefix + '.x.npy', prefix + '.y.npy'
+
+    def load_shared_data(self, file_name):
+        """
+        Memory map the arrays of a data file published in shared_dir, they are only used if they were published from
+        the current version of the data file
+        :param file_name: name of the data file in the data folder
+        :return: features and labels, or None if the data file is not published or has changed since
+        """
+        manifest_file = self.get_shared_manifest(file_name, self.shared_dir)
+        file_size = os.path.getsize(os.path.join(self.data_dir, 'data', file_name))
+        # the server removes the arrays of the previous version after it replaced the manifest, so the arrays may be
+        # gone between reading the manifest and mapping them
+        for _ in range(SHARED_RETRY):
+            if not os.path.exists(manifest_file):
+                return None
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+            if manifest['file_size'] != file_size:
+                return None
+            try:
+                x = np.load(os.path.join(self.shared_dir, manifest['x']), mmap_mode='r')
+                y = np.load(os.path.join(self.shared_dir, manifest['y']), mmap_mode='r')
+            except FileNotFoundError:
+                continue
+            if x.shape[0] == y.shape[0]:
+                return x, y
+        return None
+
+    def load_data(self, file_name):
+        """
+        Load features and resampled labels of a data file, the arrays are cached next to the data file
+        If rows have been appended to the data file since the cache was written, only the new rows are parsed
+        If shared_dir is set and the current version of the data file has been published there, the published arrays
+        are memory mapped
+        :param file_name: name of the data file in the data folder
+        :return: features and labels of all rows in the file
+        """
+        if self.shared_dir is not None:
+            data = self.load_shared_data(file_name)
+            if data is not None:
+                return data
+            print('{} is not published in {} or has changed since, loading it in this process'.format(
+                file_name, self.shared_dir))
+        data_file = os.path.join(self.data_dir, 'data', file_name)
+        cache_file = os.path.join(self.data_dir, 'data', '{}.{}.cache.npz'.format(file_name, self.output_size))
+        file_size = os.path.getsize(data_file)
+        x, y = None, None
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cache:
+                if np.array_equal(cache['x_range'], self.x_range) and \
+                        np.array_equal(cache['y_range'], self.y_range) and cache['file_size'] <= file_size:
+                    x, y = cache['x'], cache['y']
+                    if cache['file_size'] == file_size:
+                        return x, y
+        skip_rows = 0 if x is None else x.shape[0]
+        ftr = np.loadtxt(data_file, delimiter=',', usecols=self.x_range, skiprows=skip_rows, ndmin=2)
+        lbl = np.loadtxt(data_file, delimiter=',', usecols=self.y_range, skiprows=skip_rows, ndmin=2)
+        if lbl.shape[0] > 0:
+            lbl = scipy_signal.resample(lbl, self.output_size, axis=1)
+        else:
+            lbl = np.zeros((0, self.output_size))
+        if x is not None:
+            ftr, lbl = np.concatenate([x, ftr], axis=0), np.concatenate([y, lbl], axis=0)
+        savez_atomic(cache_file, x=ftr, y=lbl, x_range=self.x_range, y_range=self.y_range, file_size=file_size)
+        return ftr, lbl
+
+    def get_norm_stats(self, file_name):
+        """
+        Get mean and standard deviation of every feature and every label point of a data file
+        The statistics are cached next to the data file and recomputed when rows are appended to it
+        :param file_name: name of the data file in the data folder
+        :return: a dict of x_mean, x_std, y_mean and y_std, standard deviations of constant columns are set to 1
+        """
+        data_file = os.path.join(self.data_dir, 'data', file_name)
+        stats_file = os.path.join(self.data_dir, 'data', '{}.{}.stats.npz'.format(file_name, self.output_size))
+        file_size = os.path.getsize(data_file)
+        if os.path.exists(stats_file):
+            with np.load(stats_file) as stats:
+                if np.array_equal(stats['x_range'], self.x_range) and \
+                        np.array_equal(stats['y_range'], self.y_range) and stats['file_size'] == file_size:
+                    return {key: stats[key] for key in ('x_mean', 'x_std', 'y_mean', 'y_std')}
+        norm_stats = compute_norm_stats(*self.load_data(file_name))
+        savez_atomic(stats_file, x_range=self.x_range, y_range=self.y_range, file_size=file_size, **norm_stats)
+        return norm_stats
+
+    def get_cross_val_idx(self, row_num, is_train):
+        """
+        Get row indices of the training folds or the validation fold of the cross validation file, the rows are only
+        indexed so that memory mapped arrays are never copied as a whole
+        :param row_num: #rows in the cross validation file
+        :param is_train: if True, get the training folds, otherwise the validation fold cut to a multiple of batch_size
+        :return: row indices
+        """
+        import sklearn.utils
+        from sklearn.model_selection import KFold
+        idx = sklearn.utils.shuffle(np.arange(row_num), random_state=self.rand_seed)
+        train_idx, valid_idx = list(KFold(n_splits=self.cross_val).split(idx))[self.val_fold]
+        if is_train:
+            return idx[train_idx]
+        valid_num = valid_idx.shape[0] // self.batch_size * self.batch_size
+        return idx[valid_idx[:valid_num]]
+
+    def get_row_num(self, file_name):
+        """
+        Get number of rows in a data file
+        :param file_name: name of the data file in the data folder
+        :return: #rows in the file
+        """
+        return self.load_data(file_name)[0].shape[0]
+
+    def get_replay_idx(self, row_num):
+        """
+        Get indices of the rows used for incremental training: all rows after new_row_start plus replayed old rows
+        :param row_num: #rows in the training file
+        :return: shuffled row indices
+        """
+        new_idx = np.arange(self.new_row_start, row_num)
+        replay_num = int(round(new_idx.shape[0] * self.replay_ratio / (1 - self.replay_ratio)))
+        replay_num = min(replay_num, self.new_row_start)
+        old_idx = self.rng.choice(self.new_row_start, replay_num, replace=False)
+        return self.rng.permutation(np.concatenate([new_idx, old_idx]))
+
+    def get_sample_prob(self, ftr):
+        """
+        Get sampling probability of training rows from the error index, the error of a training row is the mean squared
+        error of its nearest samples in the error index
+        :param ftr: features of the training rows
+        :return: sampling probability of each row
+        """
+        if self.sample_prob is None or self.sample_prob.shape[0] != ftr.shape[0]:
+            error_index = np.loadtxt(os.path.join(self.data_dir, 'data', self.error_index_file), delimiter=',',
+                                     ndmin=2)
+            # columns of the index are idx, input parameters, mae and mse
+            index_ftr, index_mse = error_index[:, 1:-2], error_index[:, -1]
+            scale = np.std(ftr, axis=0)
+            scale[scale == 0] = 1
+            tree = scipy_spatial.cKDTree(index_ftr / scale)
+            _, neighbor_idx = tree.query(ftr / scale, k=min(self.neighbor_num, index_mse.shape[0]))
+            error = np.mean(index_mse[neighbor_idx].reshape(ftr.shape[0], -1), axis=1)
+            if np.sum(error) > 0:
+                self.sample_prob = (1 - self.hard_ratio) / ftr.shape[0] + self.hard_ratio * error / np.sum(error)
+            else:
+                # the indexed model fits every sample, there is nothing to oversample
+                self.sample_prob = np.full(ftr.shape[0], 1 / ftr.shape[0])
+        return self.sample_prob
 
     def data_reader(self, is_train, train_valid_tuple):
         """
@@ -41,33 +284,26 @@ class DataReader(object):
         :return: feature and label read from csv files, one line each time
         """
         if not train_valid_tuple:
-            data_file = os.path.join(self.data_dir, 'data', 'UnitCellData_V7.txt')
-            x = np.loadtxt(data_file, delimiter=',', usecols=self.x_range)
-            y = np.loadtxt(data_file, delimiter=',', usecols=self.y_range)
-            y = scipy.signal.resample(y, self.output_size, axis=1)
-            (x, y) = sklearn.utils.shuffle(x, y, random_state=0)
-            kf = KFold(n_splits=self.cross_val)
-            for cnt, (train_idx, valid_idx) in enumerate(kf.split(x)):
-                if cnt == self.val_fold:
-                    if is_train:
-                        ftr, lbl = x[train_idx, :], y[train_idx, :]
-                    else:
-                        valid_num = valid_idx.shape[0] // self.batch_size * self.batch_size
-                        ftr, lbl = x[valid_idx[:valid_num], :], y[valid_idx[:valid_num], :]
-                    for (f, l) in zip(ftr, lbl):
-                        yield f, l
+            ftr, lbl = self.load_data(CROSS_VAL_FILE)
+            idx = self.get_cross_val_idx(ftr.shape[0], is_train)
+            # the folds are split in a fixed order, training rows are reshuffled on every pass
+            if is_train:
+                idx = self.rng.permutation(idx)
         else:
-            train_data_file = os.path.join(self.data_dir, 'data', train_valid_tuple[0])
-            valid_data_file = os.path.join(self.data_dir, 'data', train_valid_tuple[1])
             if is_train:
-                ftr = np.loadtxt(train_data_file, delimiter=',', usecols=self.x_range)
-                lbl = np.loadtxt(train_data_file, delimiter=',', usecols=self.y_range)
+                ftr, lbl = self.load_data(train_valid_tuple[0])
+                if self.new_row_start is not None:
+                    idx = self.get_replay_idx(ftr.shape[0])
+                elif self.error_index_file is not None:
+                    idx = self.rng.choice(ftr.shape[0], ftr.shape[0], p=self.get_sample_prob(ftr))
+                else:
+                    idx = self.rng.permutation(ftr.shape[0])
             else:
-                ftr = np.loadtxt(valid_data_file, delimiter=',', usecols=self.x_range)
-                lbl = np.loadtxt(valid_data_file, delimiter=',', usecols=self.y_range)
-            lbl = scipy.signal.resample(lbl, self.output_size, axis=1)
-            for (f, l) in zip(ftr, lbl):
-                yield f, l
+                ftr, lbl = self.load_data(train_valid_tuple[1])
+                idx = np.arange(ftr.shape[0])
+        # rows are read one at a time so that memory mapped arrays are never copied as a whole
+        for i in idx:
+            yield ftr[i], lbl[i]
 
     def get_dataset(self, train_valid_tuple):
         """
@@ -92,7 +328,22 @@ class DataReader(object):
         :return: features, labels, training init operation, validation init operation
         """
         dataset_train, dataset_valid = self.get_dataset(train_valid_tuple)
-        dataset_train = dataset_train.shuffle(self.shuffle_zie)
+        if self.normalize:
+            if self.norm_stats is None and train_valid_tuple:
+                self.norm_stats = self.get_norm_stats(train_valid_tuple[0])
+            elif self.norm_stats is None:
+                # only the training folds, the validation fold must not leak into the statistics
+                ftr, lbl = self.load_data(CROSS_VAL_FILE)
+                idx = np.sort(self.get_cross_val_idx(ftr.shape[0], True))
+                self.norm_stats = compute_norm_stats(ftr[idx], lbl[idx])
+            x_mean, x_std, y_mean, y_std = [self.norm_stats[key].astype(np.float32)
+                                            for key in ('x_mean', 'x_std', 'y_mean', 'y_std')]
+
+            def normalize(ftr, lbl): return (ftr - x_mean) / x_std, (lbl - y_mean) / y_std
+
+            dataset_train = dataset_train.map(normalize)
+            dataset_valid = dataset_valid.map(normalize)
+        dataset_train = dataset_train.shuffle(self.shuffle_zie, seed=self.shuffle_seed)
         dataset_train = dataset_train.repeat()
         dataset_train = dataset_train.batch(self.batch_size)
         dataset_valid = dataset_valid.batch(self.batch_size)
@@ -0,0 +1,111 @@
+import os
+import glob
+import json
+import time
+import signal
+import argparse
+import tempfile
+import numpy as np
+import data_reader
+
+
+OUTPUT_SIZE = 300
+X_RANGE = [0, 1]
+Y_RANGE = [i for i in range(2, 1003)]
+TRAIN_FILE = 'TrainDataV9.txt'
+VALID_FILE = 'TestDataV9.txt'
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+POLL_INTERVAL = 60
+
+
+def read_flag():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output-size', type=int, default=OUTPUT_SIZE,
+                        help='dimensionality of the output, i.e. tconv_dims[-1] of the models using the data')
+    parser.add_argument('--x-range', type=list, default=X_RANGE, help='columns of input parameters')
+    parser.add_argument('--y-range', type=list, default=Y_RANGE, help='columns of output parameters')
+    parser.add_argument('--train-file', default=TRAIN_FILE, type=str, help='name of the training file')
+    parser.add_argument('--valid-file', default=VALID_FILE, type=str, help='name of the validation file')
+    parser.add_argument('--shared-dir', default=SHARED_DIR, type=str,
+                        help='directory to publish the arrays in, should be a tmpfs such as /dev/shm')
+    parser.add_argument('--poll-interval', default=POLL_INTERVAL, type=int,
+                        help='# seconds between checks for rows appended to the data files')
+
+    flags = parser.parse_args()
+    return flags
+
+
+def get_published_files(reader, file_name, shared_dir):
+    """
+    Get all array files published for a data file, of every version of it
+    :param reader: data reader used to load and resample the data file
+    :param file_name: name of the data file in the data folder
+    :param shared_dir: directory the arrays are published in
+    :return: list of array files
+    """
+    prefix = reader.get_shared_manifest(file_name, shared_dir)[:-len('.json')]
+    return glob.glob(glob.escape(prefix) + '.*.npy')
+
+
+def publish(reader, file_name, shared_dir):
+    """
+    Write the preprocessed arrays of a data file into the shared directory
+    Arrays of every version of the data file get their own names, the manifest pointing readers to them is replaced
+    once both arrays are written, so readers always map features and labels of the same version. Arrays of the older
+    versions are removed, readers that already mapped them keep them until they are done
+    :param reader: data reader used to load and resample the data file
+    :param file_name: name of the data file in the data folder
+    :param shared_dir: directory to publish the arrays in
+    :return: size of the data file when it was published
+    """
+    file_size = os.path.getsize(os.path.join(reader.data_dir, 'data', file_name))
+    shared_files = reader.get_shared_files(file_name, shared_dir, file_size)
+    for array, shared_file in zip(reader.load_data(file_name), shared_files):
+        tmp_file = '{}.{}.tmp.npy'.format(shared_file[:-4], os.getpid())
+        np.save(tmp_file, np.ascontiguousarray(array, dtype=np.float32))
+        os.rename(tmp_file, shared_file)
+    manifest_file = reader.get_shared_manifest(file_name, shared_dir)
+    tmp_file = '{}.{}.tmp'.format(manifest_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump({'file_size': file_size, 'x': os.path.basename(shared_files[0]),
+                   'y': os.path.basename(shared_files[1])}, f)
+    os.rename(tmp_file, manifest_file)
+    for shared_file in get_published_files(reader, file_name, shared_dir):
+        if shared_file not in shared_files:
+            os.remove(shared_file)
+    print('Published {} in {}'.format(file_name, shared_dir))
+    return file_size
+
+
+def main(flags):
+    reader = data_reader.DataReader(input_size=len(flags.x_range), output_size=flags.output_size,
+                                    x_range=flags.x_range, y_range=flags.y_range)
+    file_names = [flags.train_file, flags.valid_file]
+    # the cross validation file is read by the readers that are not given a train and a valid file
+    if os.path.exists(os.path.join(reader.data_dir, 'data', data_reader.CROSS_VAL_FILE)):
+        file_names.append(data_reader.CROSS_VAL_FILE)
+    file_sizes = {file_name: publish(reader, file_name, flags.shared_dir) for file_name in file_names}
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while True:
+            time.sleep(flags.poll_interval)
+            for file_name in file_names:
+                if os.path.getsize(os.path.join(reader.data_dir, 'data', file_name)) != file_sizes[file_name]:
+                    file_sizes[file_name] = publish(reader, file_name, flags.shared_dir)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for file_name in file_names:
+            manifest_file = reader.get_shared_manifest(file_name, flags.shared_dir)
+            for shared_file in get_published_files(reader, file_name, flags.shared_dir) + [manifest_file]:
+                if os.path.exists(shared_file):
+                    os.remove(shared_file)
+        print('Removed published data from {}'.format(flags.shared_dir))
+
+
+if __name__ == '__main__':
+    flags = read_flag()
+    main(flags)
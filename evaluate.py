@@ -2,11 +2,12 @@ import os
 import csv
 import argparse
 import numpy as np
-import matplotlib.pyplot as plt
+import lazy_loader
 import utils
 import data_reader
 import network_maker
 import network_helper
+plt = lazy_loader.lazy_import('matplotlib.pyplot')
 
 
 INPUT_SIZE = 2
@@ -46,6 +47,12 @@ def read_flag():
     parser.add_argument('--decay-rate', default=DECAY_RATE, type=float,
                         help='decay learn rate by multiplying this factor')
     parser.add_argument('--force-run', default=FORCE_RUN, type=bool, help='force it to rerun')
+    parser.add_argument('--no-write-pred', dest='write_pred', action='store_false',
+                        help='only compute metrics in the session, do not write predictions into csv files')
+    parser.add_argument('--compact', action='store_true',
+                        help='load the compact checkpoint of the model, write it from the full one if it is missing')
+    parser.add_argument('--half-precision', action='store_true',
+                        help='store the compact checkpoint written by --compact in float16')
     parser.add_argument('--model-name', default=MODEL_NAME, type=str, help='name of the model')
     parser.add_argument('--train-file', default=TRAIN_FILE, type=str, help='name of the training file')
     parser.add_argument('--valid-file', default=VALID_FILE, type=str, help='name of the validation file')
@@ -70,9 +77,43 @@ def compare_truth_pred(pred_file, truth_file):
     return mae, mse
 
 
+def save_error_index(feature, mae, mse, index_file):
+    """
+    Save per-sample errors together with input parameters, sorted from the largest mse to the smallest
+    The index can be passed to DataReader to oversample the input space where the model performs worst
+    :param feature: input parameters of the samples
+    :param mae: mean-absolute-error of each sample
+    :param mse: mean-squared-error of each sample
+    :param index_file: full path to the index file
+    :return:
+    """
+    order = np.argsort(-mse)
+    index = np.concatenate([order[:, np.newaxis], feature[order, :], mae[order, np.newaxis],
+                            mse[order, np.newaxis]], axis=1)
+    header = ','.join(['idx'] + ['x{}'.format(i) for i in range(feature.shape[1])] + ['mae', 'mse'])
+    np.savetxt(index_file, index, delimiter=',', header=header,
+               fmt=['%d'] + ['%.6e' for _ in range(feature.shape[1])] + ['%.6e', '%.6e'])
+
+
+def save_error_profile(mae_profile, mse_profile, profile_file):
+    """
+    Save mean-absolute-error and mean-squared-error at every point of the spectra, averaged over the samples
+    :param mae_profile: mean-absolute-error at every point
+    :param mse_profile: mean-squared-error at every point
+    :param profile_file: full path to the profile file
+    :return:
+    """
+    profile = np.stack([np.arange(mae_profile.shape[0]), mae_profile, mse_profile], axis=1)
+    np.savetxt(profile_file, profile, delimiter=',', header='point,mae,mse', fmt=['%d', '%.6e', '%.6e'])
+
+
 def main(flags):
     ckpt_dir = os.path.join(os.path.dirname(__file__), 'models', flags.model_name)
     fc_filters, tconv_dims, tconv_filters = network_helper.get_parameters(ckpt_dir)
+    upsample_mode = network_helper.get_parameter(ckpt_dir, 'upsample_mode', default='tconv')
+    ensemble_size = int(network_helper.get_parameter(ckpt_dir, 'ensemble_size', default=1))
+    gradient_checkpoint = network_helper.get_parameter(ckpt_dir, 'gradient_checkpoint') == 'True'
+    norm_stats = network_helper.get_norm_stats(ckpt_dir)
 
     # initialize data reader
     if len(tconv_dims) == 0:
@@ -82,27 +123,56 @@ def main(flags):
     reader = data_reader.DataReader(input_size=flags.input_size, output_size=output_size,
                                     x_range=flags.x_range, y_range=flags.y_range, cross_val=flags.cross_val,
                                     val_fold=flags.val_fold, batch_size=flags.batch_size,
-                                    shuffle_size=flags.shuffle_size)
+                                    shuffle_size=flags.shuffle_size, norm_stats=norm_stats)
     features, labels, train_init_op, valid_init_op = reader.get_data_holder_and_init_op(
         (flags.train_file, flags.valid_file)
     )
 
     # make network
-    ntwk = network_maker.CnnNetwork(features, labels, utils.my_model_fn, flags.batch_size,
-                                    fc_filters=fc_filters, tconv_dims=tconv_dims,
-                                    tconv_filters=tconv_filters, learn_rate=flags.learn_rate,
-                                    decay_step=flags.decay_step, decay_rate=flags.decay_rate, make_folder=False)
+    if ensemble_size > 1:
+        ntwk = network_maker.EnsembleNetwork(features, labels, utils.my_model_fn, flags.batch_size,
+                                             ensemble_size=ensemble_size, fc_filters=fc_filters,
+                                             tconv_dims=tconv_dims, tconv_filters=tconv_filters,
+                                             learn_rate=flags.learn_rate, decay_step=flags.decay_step,
+                                             decay_rate=flags.decay_rate, make_folder=False,
+                                             upsample_mode=upsample_mode, gradient_checkpoint=gradient_checkpoint,
+                                             norm_stats=norm_stats)
+    else:
+        ntwk = network_maker.CnnNetwork(features, labels, utils.my_model_fn, flags.batch_size,
+                                        fc_filters=fc_filters, tconv_dims=tconv_dims,
+                                        tconv_filters=tconv_filters, learn_rate=flags.learn_rate,
+                                        decay_step=flags.decay_step, decay_rate=flags.decay_rate,
+                                        make_folder=False, upsample_mode=upsample_mode,
+                                        gradient_checkpoint=gradient_checkpoint, norm_stats=norm_stats)
 
     # evaluate the results if the results does not exist or user force to re-run evaluation
     save_file = os.path.join(os.path.dirname(__file__), 'data', 'test_pred_{}.csv'.format(flags.model_name))
     if FORCE_RUN or (not os.path.exists(save_file)):
         print('Evaluating the model ...')
-        pred_file, truth_file = ntwk.evaluate(valid_init_op, ckpt_dir=ckpt_dir, model_name=flags.model_name)
+        # ensembles also write the standard deviation of predictions to data/test_std_[model_name].csv
+        _, _, metrics = ntwk.evaluate(valid_init_op, ckpt_dir=ckpt_dir, model_name=flags.model_name,
+                                      write_file=flags.write_pred, compact=flags.compact,
+                                      half=flags.half_precision)
+        mae, mse = metrics['sample_mae'], metrics['sample_mse']
+        print('MAE: {:.4e}, MSE: {:.4e}, MSE percentiles: {}'.format(
+            metrics['mae'], metrics['mse'],
+            ', '.join(['p{}={:.4e}'.format(p, v) for p, v in sorted(metrics['mse_percentile'].items())])))
+        if metrics['mse_out_of_range'] > 0:
+            print('{} samples have an MSE out of the range of the percentile histogram, percentiles among them are '
+                  'nan, MSE range: [{:.4e}, {:.4e}]'.format(metrics['mse_out_of_range'], metrics['mse_min'],
+                                                            metrics['mse_max']))
+        profile_file = os.path.join(os.path.dirname(__file__), 'data', 'error_profile_{}.csv'.format(flags.model_name))
+        save_error_profile(metrics['mae_profile'], metrics['mse_profile'], profile_file)
+        print('Worst point of the spectra: {} (MSE={:.4e}), error profile written to {}'.format(
+            np.argmax(metrics['mse_profile']), np.max(metrics['mse_profile']), profile_file))
     else:
         pred_file = save_file
         truth_file = os.path.join(os.path.dirname(__file__), 'data', 'test_truth.csv')
+        mae, mse = compare_truth_pred(pred_file, truth_file)
 
-    mae, mse = compare_truth_pred(pred_file, truth_file)
+    feature = reader.load_data(flags.valid_file)[0][:mse.shape[0], :]
+    save_error_index(feature, mae, mse, os.path.join(os.path.dirname(__file__), 'data',
+                                                     'error_index_{}.csv'.format(flags.model_name)))
 
     plt.figure(figsize=(12, 6))
     plt.hist(mse, bins=100)
@@ -0,0 +1,32 @@
+import sys
+import types
+import importlib
+import importlib.util
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that is imported on the first access to one of its attributes
+    The real module is imported with the regular import system, so packages that replace themselves in sys.modules
+    while they are imported (e.g. tensorflow 1.15 with tensorflow_core) are supported
+    """
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self.__name__), attr)
+        setattr(self, attr, value)
+        return value
+
+
+def lazy_import(name):
+    """
+    Import a module lazily, the module is only executed when one of its attributes is accessed for the first time
+    Heavy dependencies (tensorflow, matplotlib, scipy, ...) are imported this way so that entry points only pay
+    for them on the code paths that use them
+    :param name: full name of the module, e.g. 'matplotlib.pyplot'
+    :return: the module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    # finding a submodule imports its parent packages, only check that the top-level package is installed
+    if importlib.util.find_spec(name.partition('.')[0]) is None:
+        raise ImportError('No module named {}'.format(name))
+    return LazyModule(name)
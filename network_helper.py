@@ -1,9 +1,10 @@
 import os
 import time
-import tfplot
 import numpy as np
-import tensorflow as tf
-import matplotlib.pyplot as plt
+import lazy_loader
+tf = lazy_loader.lazy_import('tensorflow')
+plt = lazy_loader.lazy_import('matplotlib.pyplot')
+tfplot = lazy_loader.lazy_import('tfplot')
 
 
 class Hook(object):
@@ -63,7 +64,7 @@ class ValidationHook(Hook):
     This hook monitors performance on the valiation set
     """
     def __init__(self, valid_step, valid_init_op, truth, pred, loss, ckpt_dir=None, write_summary=False,
-                 curve_num=6):
+                 curve_num=6, lr_plateau=None):
         """
         Initialize the hook
         :param valid_step: # steps between evaluations
@@ -74,6 +75,7 @@ class ValidationHook(Hook):
         :param ckpt_dir: ckpt_dir: checkpoint directory, only use it if write_summary is True
         :param write_summary: log summary or not
         :param curve_num: #curve plots in validation images
+        :param lr_plateau: if it's not none, a ReduceLROnPlateau updated with the loss of every evaluation
         """
         super(ValidationHook, self).__init__()
         self.valid_step = valid_step
@@ -83,11 +85,14 @@ class ValidationHook(Hook):
         self.loss = loss
         self.write_summary = write_summary
         self.curve_num = curve_num
+        self.lr_plateau = lr_plateau
         if self.write_summary:
             assert ckpt_dir is not None
             self.valid_mse_summary = HookValueSummary('valid_mse')
             self.valid_curve_summary = HookCurvePlotSummary('pred_plot')
         self.time_cnt = time.time()
+        # (step, mean loss) of every evaluation
+        self.loss_record = []
 
     def run(self, sess, writer=None):
         """
@@ -108,24 +113,69 @@ class ValidationHook(Hook):
             except tf.errors.OutOfRangeError:
                 pass
             loss_mean = np.mean(loss_val)
+            self.loss_record.append((self.step, loss_mean))
             print('Eval @ Step {}, loss: {:.3f}, duration {:.3f}s'.
                   format(self.step, loss_mean, time.time()-self.time_cnt))
             self.time_cnt = time.time()
+            if self.lr_plateau is not None:
+                self.lr_plateau.update(loss_mean, sess)
             if self.write_summary:
                 self.valid_mse_summary.log(loss_mean, self.step, sess, writer)
                 self.valid_curve_summary.log(truth, pred, self.step, writer, self.curve_num)
 
 
+class ReduceLROnPlateau(object):
+    """
+    Reduce the learning rate when the validation loss stops improving, used by ValidationHook
+    """
+    def __init__(self, lr_scale, factor=0.5, patience=3, min_delta=0.0):
+        """
+        Initialize the scheduler
+        :param lr_scale: variable that scales the learning rate, CnnNetwork.lr_scale of the 'plateau' schedule
+        :param factor: multiply the learning rate by this factor when the loss stops improving
+        :param patience: # evaluations without improvement before reducing the learning rate
+        :param min_delta: minimum decrease of the loss counted as an improvement
+        """
+        self.lr_scale = lr_scale
+        self.factor = factor
+        self.patience = patience
+        self.min_delta = min_delta
+        self.scale = tf.placeholder(tf.float32, [])
+        self.assign_op = tf.assign(self.lr_scale, self.scale)
+        self.best_loss = np.inf
+        self.wait = 0
+
+    def update(self, loss, sess):
+        """
+        Update the scheduler with the loss of an evaluation
+        :param loss: validation loss
+        :param sess: current session
+        :return:
+        """
+        if loss < self.best_loss - self.min_delta:
+            self.best_loss = loss
+            self.wait = 0
+        else:
+            self.wait += 1
+            if self.wait >= self.patience:
+                scale = sess.run(self.lr_scale) * self.factor
+                sess.run(self.assign_op, feed_dict={self.scale: scale})
+                self.wait = 0
+                print('Validation loss stopped improving, learning rate scaled to {:.3e}'.format(scale))
+
+
 class HookValueSummary(object):
     """
     Write summary inside hooks
     """
-    def __init__(self, summary_name, d_type=tf.float32):
+    def __init__(self, summary_name, d_type=None):
         """
         Initialize the summaries
         :param summary_name: name of this summary
-        :param d_type: data type to write into the summary
+        :param d_type: data type to write into the summary, default to tf.float32
         """
+        if d_type is None:
+            d_type = tf.float32
         self.val = tf.placeholder(d_type, [])
         self.val_summary_op = tf.summary.scalar(summary_name, self.val)
 
@@ -202,4 +252,50 @@ def get_parameters(model_dir):
         elif line[:13] == 'tconv_filters':
             line = replace_str(line)
             tconv_filters = tuple([int(s) for s in line.split() if s.isdigit()])
-    return fc_filters, tconv_dims, tconv_filters
\ No newline at end of file
+    return fc_filters, tconv_dims, tconv_filters
+
+
+def get_parameter(model_dir, param_name, default=None):
+    """
+    Read a single parameter recorded in model_meta.txt
+    :param model_dir: directory of the model
+    :param param_name: name of the parameter, as recorded by CnnNetwork.write_record()
+    :param default: value to return if the parameter is not recorded, e.g. models trained before it was added
+    :return: the recorded value as a string, or default
+    """
+    file = os.path.join(model_dir, 'model_meta.txt')
+    with open(file, 'r') as f:
+        lines = f.readlines()
+    in_params = False
+    for line in lines:
+        if line.strip() == 'params:':
+            in_params = True
+        elif in_params and line.startswith('{}: '.format(param_name)):
+            return line[len(param_name)+2:].strip()
+    return default
+
+
+def get_norm_stats(model_dir):
+    """
+    Read the statistics the model was trained with, as stored by CnnNetwork
+    :param model_dir: directory of the model
+    :return: a dict of x_mean, x_std, y_mean and y_std, or None if the model was trained on data that is not normalized
+    """
+    file = os.path.join(model_dir, 'norm_stats.npz')
+    if not os.path.exists(file):
+        return None
+    with np.load(file) as stats:
+        return {key: stats[key] for key in stats.files}
+
+
+def get_latest_model(models_dir):
+    """
+    Find the most recent model that has a checkpoint
+    :param models_dir: directory where models are stored, each in a timestamp folder
+    :return: directory of the latest model, or None if there is no trained model
+    """
+    for model_name in sorted(os.listdir(models_dir), reverse=True):
+        model_dir = os.path.join(models_dir, model_name)
+        if os.path.isdir(model_dir) and tf.train.latest_checkpoint(model_dir):
+            return model_dir
+    return None
@@ -1,8 +1,16 @@
 import os
+import re
 import time
 import inspect
 import numpy as np
-import tensorflow as tf
+import lazy_loader
+tf = lazy_loader.lazy_import('tensorflow')
+
+
+LR_SCHEDULES = ('exp_decay', 'cosine', 'one_cycle', 'plateau')
+COMPACT_FILE = 'model_compact.npz'
+# ops whose outputs share the buffer of their inputs, they take no memory of their own
+ALIAS_OPS = ('Identity', 'IdentityN', 'ExpandDims', 'Squeeze', 'Reshape')
 
 
 class CnnNetwork(object):
@@ -10,7 +18,9 @@ class CnnNetwork(object):
                  tconv_dims=(60, 120, 240), tconv_filters=(1, 1, 1),
                  learn_rate=1e-4, decay_step=200, decay_rate=0.1,
                  ckpt_dir=os.path.join(os.path.dirname(__file__), 'models'),
-                 make_folder=True):
+                 make_folder=True, upsample_mode='tconv', data_rows=None, gradient_checkpoint=False,
+                 lr_schedule='exp_decay', total_step=None, warmup_step=0, min_learn_rate=0.0, seed=None,
+                 norm_stats=None):
         """
         Initialize a Network class
         :param features: input features
@@ -25,6 +35,18 @@ class CnnNetwork(object):
         :param decay_rate: decay learn rate by multiplying this factor
         :param ckpt_dir: checkpoint directory, default to ./models
         :param make_folder: if True, create the directory if not exists
+        :param upsample_mode: upsampling block used by model_fn, see utils.UPSAMPLE_MODES
+        :param data_rows: #rows in the training file, recorded so that incremental training can find new rows
+        :param gradient_checkpoint: if True, model_fn recomputes activations of the upsampling layers in the backward
+                                    pass instead of keeping them in memory
+        :param lr_schedule: learning rate schedule, one of LR_SCHEDULES, see make_learn_rate()
+        :param total_step: #steps of training, required by 'cosine' and 'one_cycle'
+        :param warmup_step: increase the learning rate linearly from 0 during this number of steps, for 'one_cycle'
+                            it's the number of steps to reach the peak learning rate
+        :param min_learn_rate: learning rate at the end of 'cosine' and 'one_cycle'
+        :param seed: random seed of the graph and of model_fn, None for an unseeded initialization
+        :param norm_stats: if it's not none, statistics the data reader normalized features and labels with,
+                           predictions are mapped back with them and they are stored in norm_stats.npz
         """
         self.features = features
         self.labels = labels
@@ -34,25 +56,152 @@ class CnnNetwork(object):
         assert len(tconv_dims) == len(tconv_filters)
         self.tconv_dims = tconv_dims
         self.tconv_filters = tconv_filters
+        self.upsample_mode = upsample_mode
+        self.data_rows = data_rows
+        self.gradient_checkpoint = gradient_checkpoint
+        self.seed = seed
+        self.normalize = norm_stats is not None
+        if self.seed is not None:
+            tf.set_random_seed(self.seed)
         self.global_step = tf.Variable(0, dtype=tf.int64, trainable=False, name='global_step')
-        self.learn_rate = tf.train.exponential_decay(learn_rate, self.global_step,
-                                                     decay_step, decay_rate, staircase=True)
+        self.lr_schedule = lr_schedule
+        self.lr_scale = None
+        self.learn_rate = self.make_learn_rate(learn_rate, decay_step, decay_rate, total_step, warmup_step,
+                                               min_learn_rate)
 
         self.ckpt_dir = os.path.join(ckpt_dir, time.strftime('%Y%m%d_%H%M%S', time.gmtime()))
         if not os.path.exists(self.ckpt_dir) and make_folder:
             os.makedirs(self.ckpt_dir)
             self.write_record()
+            if self.normalize:
+                np.savez(os.path.join(self.ckpt_dir, 'norm_stats.npz'), **norm_stats)
+        # set after write_record() so that the arrays are not dumped into model_meta.txt
+        self.norm_stats = norm_stats
 
+        op_num = len(tf.get_default_graph().get_operations())
         self.logits = self.create_graph()
+        self.memory_report = self.make_memory_report(op_num)
+        self.preds = self.denormalize(self.logits)
+        self.truth = self.denormalize(self.labels)
+        # mean squared error in the scale of the data, comparable between models trained with and without normalization
+        self.data_mse = tf.reduce_mean(tf.square(self.preds - self.truth))
         self.loss = self.make_loss()
         self.optm = self.make_optimizer()
 
-    def create_graph(self):
+    def make_learn_rate(self, learn_rate, decay_step, decay_rate, total_step, warmup_step, min_learn_rate):
+        """
+        Make the learning rate schedule, steps are counted from self.start_step, the global step training started at,
+        so that a warm started training runs the whole schedule again
+        'exp_decay': multiply learn_rate by decay_rate every decay_step steps
+        'cosine': cosine annealing from learn_rate to min_learn_rate at total_step
+        'one_cycle': increase linearly from learn_rate/25 to learn_rate until warmup_step (30% of total_step if it's
+                     0), then cosine annealing to min_learn_rate at total_step
+        'plateau': learn_rate multiplied by self.lr_scale, which is reduced by a network_helper.ReduceLROnPlateau
+                   when the validation loss stops improving, a warm started training resets it to 1
+        :param learn_rate: learning rate
+        :param decay_step: decay learning rate at this number of steps
+        :param decay_rate: decay learn rate by multiplying this factor
+        :param total_step: #steps of training
+        :param warmup_step: #steps of linear warm up
+        :param min_learn_rate: learning rate at the end of 'cosine' and 'one_cycle'
+        :return: learning rate tensor
+        """
+        assert self.lr_schedule in LR_SCHEDULES
+        with tf.variable_scope('learn_rate'):
+            # a local variable, it's not restored from checkpoints but set by train()
+            self.start_step = tf.Variable(0, dtype=tf.int64, trainable=False, name='start_step',
+                                          collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            run_step = self.global_step - self.start_step
+            step = tf.cast(run_step, tf.float32)
+            if self.lr_schedule == 'exp_decay':
+                lr = tf.train.exponential_decay(learn_rate, run_step, decay_step, decay_rate, staircase=True)
+            elif self.lr_schedule == 'plateau':
+                self.lr_scale = tf.Variable(1.0, trainable=False, name='lr_scale')
+                lr = learn_rate * self.lr_scale
+            else:
+                assert total_step is not None
+                if self.lr_schedule == 'one_cycle':
+                    warmup_step = warmup_step if warmup_step > 0 else int(0.3 * total_step)
+                progress = tf.clip_by_value((step - warmup_step) / max(total_step - warmup_step, 1), 0.0, 1.0)
+                lr = min_learn_rate + (learn_rate - min_learn_rate) * 0.5 * (1 + tf.cos(np.pi * progress))
+                if self.lr_schedule == 'one_cycle':
+                    ramp = learn_rate / 25 + (learn_rate - learn_rate / 25) * step / max(warmup_step, 1)
+                    return tf.where(step < warmup_step, ramp, lr)
+            if warmup_step > 0:
+                lr = lr * tf.minimum((step + 1) / warmup_step, 1.0)
+            return lr
+
+    def create_graph(self, seed=None):
         """
         Create model graph
+        :param seed: random seed of model_fn, default to self.seed
         :return: outputs of the last layer
         """
-        return self.model_fn(self.features, self.batch_size, self.fc_filters, self.tconv_dims, self.tconv_filters)
+        return self.model_fn(self.features, self.batch_size, self.fc_filters, self.tconv_dims, self.tconv_filters,
+                             upsample_mode=self.upsample_mode, gradient_checkpoint=self.gradient_checkpoint,
+                             seed=self.seed if seed is None else seed)
+
+    def make_memory_report(self, op_num):
+        """
+        Report #parameters and bytes of activations kept for the backward pass of one batch, the report is printed
+        and written into memory_report.txt in the checkpoint folder
+        :param op_num: #operations in the graph before the model graph was created
+        :return: a dict of the report
+        """
+        def tensor_bytes(tensor):
+            return int(np.prod(tensor.get_shape().as_list())) * tensor.dtype.base_dtype.size
+
+        def final_consumers(tensor):
+            # alias ops forward the buffer of their input, the tensor is really used by the consumers behind them
+            ops = []
+            for op in tensor.consumers():
+                if op.type in ALIAS_OPS:
+                    outputs = [op.outputs[i] for i, t in enumerate(op.inputs) if t is tensor and i < len(op.outputs)]
+                    for output in outputs:
+                        ops.extend(final_consumers(output))
+                else:
+                    ops.append(op)
+            return ops
+
+        # activations are all the tensors computed from the features inside the model graph
+        model_ops = set(tf.get_default_graph().get_operations()[op_num:])
+        activations, queue = set(), [self.features]
+        while queue:
+            for op in queue.pop().consumers():
+                if op in model_ops:
+                    for output in op.outputs:
+                        if output not in activations and output.get_shape().is_fully_defined():
+                            activations.add(output)
+                            queue.append(output)
+
+        # inside a gradient checkpointing block, only the tensors used outside of the block are kept, the rest are
+        # recomputed one block at a time in the backward pass
+        activations = set(t for t in activations if t.op.type not in ALIAS_OPS)
+        kept_bytes, block_bytes = 0, {}
+        for tensor in activations:
+            block = re.match(r'(.*up_block\d+)/', tensor.name)
+            if block is None or any(not op.name.startswith(block.group(1) + '/') for op in final_consumers(tensor)):
+                kept_bytes += tensor_bytes(tensor)
+            else:
+                block_bytes[block.group(1)] = block_bytes.get(block.group(1), 0) + tensor_bytes(tensor)
+        param_num = sum([int(np.prod(v.get_shape().as_list())) for v in tf.trainable_variables()])
+        report = {
+            'param_num': param_num,
+            'param_bytes': sum([tensor_bytes(v) for v in tf.trainable_variables()]),
+            'activation_bytes': sum([tensor_bytes(t) for t in activations]),
+            'peak_activation_bytes': kept_bytes + max(list(block_bytes.values()) + [0]),
+        }
+
+        print('#params: {}, params: {:.2f}MB, activations per batch: {:.2f}MB, peak activations per batch: {:.2f}MB'.
+              format(report['param_num'], report['param_bytes']/2**20, report['activation_bytes']/2**20,
+                     report['peak_activation_bytes']/2**20))
+        if os.path.exists(self.ckpt_dir):
+            with open(os.path.join(self.ckpt_dir, 'memory_report.txt'), 'w') as f:
+                f.write('batch_size: {}\n'.format(self.batch_size))
+                f.write('gradient_checkpoint: {}\n'.format(self.gradient_checkpoint))
+                for key, val in sorted(report.items()):
+                    f.write('{}: {}\n'.format(key, val))
+        return report
 
     def write_record(self):
         """
@@ -70,6 +219,20 @@ class CnnNetwork(object):
             for key, val in params:
                 f.write('{}: {}\n'.format(key, val))
 
+    def denormalize(self, spectra, shift=True):
+        """
+        Map normalized spectra back to the scale of the data, the loss is computed on the normalized ones
+        :param spectra: normalized spectra, e.g. logits or labels
+        :param shift: if False, only rescale, e.g. for standard deviations
+        :return: spectra in the scale of the data, unchanged if the data is not normalized
+        """
+        if not self.normalize:
+            return spectra
+        spectra = spectra * self.norm_stats['y_std'].astype(np.float32)
+        if shift:
+            spectra = spectra + self.norm_stats['y_mean'].astype(np.float32)
+        return spectra
+
     def make_loss(self):
         """
         Make cross entropy loss
@@ -95,67 +258,275 @@ class CnnNetwork(object):
         saver = tf.train.Saver(var_list=tf.global_variables(), max_to_keep=1)
         saver.save(sess, os.path.join(self.ckpt_dir, 'model.ckpt'))
 
-    def load(self, sess, ckpt_dir):
+    def save_compact(self, sess, ckpt_dir=None, half=False):
+        """
+        Save the trainable variables only into an npz file for inference, optimizer slots and global_step are skipped
+        :param sess: current running session
+        :param ckpt_dir: directory to save the file in, default to self.ckpt_dir
+        :param half: if True, store the weights in float16
+        :return: full path to the compact checkpoint
+        """
+        ckpt_dir = self.ckpt_dir if ckpt_dir is None else ckpt_dir
+        variables = tf.trainable_variables()
+        values = sess.run(variables)
+        if half:
+            values = [val.astype(np.float16) for val in values]
+        compact_file = os.path.join(ckpt_dir, COMPACT_FILE)
+        np.savez(compact_file, *values, names=np.array([v.op.name for v in variables]))
+        return compact_file
+
+    def load_compact(self, sess, ckpt_dir):
+        """
+        Load the model from the compact checkpoint written by save_compact()
+        Weights are fed into the initializers of the trainable variables, so the whole model is loaded in one run
+        :param sess: current running session
+        :param ckpt_dir: checkpoint directory
+        :return:
+        """
+        compact_file = os.path.join(ckpt_dir, COMPACT_FILE)
+        with np.load(compact_file) as data:
+            values = {name: data['arr_{}'.format(i)] for i, name in enumerate(data['names'])}
+        feed_dict = {}
+        for v in tf.trainable_variables():
+            if v.op.name not in values:
+                raise ValueError('{} not found in {}'.format(v.op.name, compact_file))
+            feed_dict[v.initial_value] = values[v.op.name].astype(v.dtype.base_dtype.as_numpy_dtype)
+        sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()], feed_dict=feed_dict)
+        print('loaded {}'.format(compact_file))
+
+    def load(self, sess, ckpt_dir, compact=False, half=False):
         """
         Load the model from the checkpoint directory
         :param sess: current running session
         :param ckpt_dir: checkpoint directory
+        :param compact: if True, load the compact checkpoint, it's written from the full checkpoint if it's not there
+        :param half: if True, a compact checkpoint written here stores the weights in float16
         :return:
         """
+        if compact and os.path.exists(os.path.join(ckpt_dir, COMPACT_FILE)):
+            self.load_compact(sess, ckpt_dir)
+            return
         sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
-        saver = tf.train.Saver(var_list=tf.global_variables())
         latest_check_point = tf.train.latest_checkpoint(ckpt_dir)
+        # the state of a learning rate schedule the checkpoint was not trained with keeps its initial value, any other
+        # missing variable means the checkpoint is of another model
+        saved = tf.train.NewCheckpointReader(latest_check_point).get_variable_to_shape_map()
+        var_list = [v for v in tf.global_variables() if v.op.name in saved]
+        missing = [v for v in tf.global_variables() if v.op.name not in saved]
+        trainable = set(v.op.name for v in tf.trainable_variables())
+        not_found = [v.op.name for v in missing if v.op.name in trainable or not v.op.name.startswith('learn_rate/')]
+        if not_found:
+            raise ValueError('{} not found in {}'.format(', '.join(not_found), latest_check_point))
+        if missing:
+            print('not in {}, initialized: {}'.format(latest_check_point, ', '.join(v.op.name for v in missing)))
+        saver = tf.train.Saver(var_list=var_list)
         saver.restore(sess, latest_check_point)
         print('loaded {}'.format(latest_check_point))
+        if compact:
+            print('wrote {}'.format(self.save_compact(sess, ckpt_dir, half=half)))
 
-    def train(self, train_init_op, step_num, hooks, write_summary=False):
+    def train(self, train_init_op, step_num, hooks, write_summary=False, restore_dir=None, compact=False,
+              half=False):
         """
         Train the model with step_num steps
         :param train_init_op: training dataset init operation
         :param step_num: number of steps to train
         :param hooks: hooks for monitoring the training process
         :param write_summary: write summary into tensorboard of not
+        :param restore_dir: if it's not none, warm start from the latest checkpoint in this directory
+        :param compact: if True, also save a compact checkpoint for inference
+        :param half: if True, the compact checkpoint stores the weights in float16
         :return:
         """
         with tf.Session() as sess:
-            sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+            if restore_dir:
+                self.load(sess, restore_dir)
+                # the learning rate schedule starts over from the restored global step at the full learning rate
+                sess.run(tf.assign(self.start_step, self.global_step))
+                if self.lr_scale is not None:
+                    sess.run(tf.assign(self.lr_scale, 1.0))
+            else:
+                sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
 
             if write_summary:
                 summary_writer = tf.summary.FileWriter(self.ckpt_dir, sess.graph)
             else:
                 summary_writer = None
 
+            sess.run(train_init_op)
             for i in range(int(step_num)):
-                sess.run(train_init_op)
-                sess.run(self.optm)
+                try:
+                    sess.run(self.optm)
+                except tf.errors.OutOfRangeError:
+                    # validation hooks leave the iterator at the end of the validation set
+                    sess.run(train_init_op)
+                    sess.run(self.optm)
 
                 for hook in hooks:
                     hook.run(sess, writer=summary_writer)
             self.save(sess)
+            if compact:
+                self.save_compact(sess, half=half)
+
+    def make_metrics(self, percentiles=(50, 90, 99), bin_num=2000, log_range=(-10.0, 10.0)):
+        """
+        Make streaming metrics of the predictions in the scale of the data, they are accumulated in local variables
+        batch by batch
+        Percentiles of the per-sample mean squared error come from a histogram of log10(mse) with bin_num bins
+        :param percentiles: percentiles of the per-sample mean squared error to compute
+        :param bin_num: #bins of the histogram
+        :param log_range: range of log10(mse) covered by the histogram, a percentile that falls among the errors out of
+                          the range is nan, mse_min, mse_max and mse_out_of_range tell where they are
+        :return: a dict of metric tensors, op to update the metrics with a batch, per-sample mae and mse of a batch
+        """
+        with tf.variable_scope('metrics'):
+            err = self.preds - self.truth
+            sample_mae = tf.reduce_mean(tf.abs(err), axis=1)
+            sample_mse = tf.reduce_mean(tf.square(err), axis=1)
+            mae, mae_update = tf.metrics.mean_absolute_error(self.truth, self.preds)
+            mse, mse_update = tf.metrics.mean_squared_error(self.truth, self.preds)
+            mae_profile, mae_profile_update = tf.metrics.mean_tensor(tf.reduce_mean(tf.abs(err), axis=0))
+            mse_profile, mse_profile_update = tf.metrics.mean_tensor(tf.reduce_mean(tf.square(err), axis=0))
+
+            hist = tf.Variable(tf.zeros([bin_num], tf.int32), trainable=False, name='mse_hist',
+                               collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            # #errors below and above the range of the histogram, they are counted in its edge bins
+            out_of_range = tf.Variable(tf.zeros([2], tf.int32), trainable=False, name='mse_out_of_range',
+                                       collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            mse_min = tf.Variable(np.inf, dtype=tf.float32, trainable=False, name='mse_min',
+                                  collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            mse_max = tf.Variable(-np.inf, dtype=tf.float32, trainable=False, name='mse_max',
+                                  collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            log_mse = tf.log(tf.maximum(sample_mse, 1e-30)) / np.log(10)
+            hist_update = tf.group(
+                tf.assign_add(hist, tf.histogram_fixed_width(log_mse, tf.constant(log_range, tf.float32),
+                                                             nbins=bin_num)),
+                tf.assign_add(out_of_range, tf.stack([tf.reduce_sum(tf.cast(log_mse < log_range[0], tf.int32)),
+                                                      tf.reduce_sum(tf.cast(log_mse >= log_range[1], tf.int32))])),
+                tf.assign(mse_min, tf.minimum(mse_min, tf.reduce_min(sample_mse))),
+                tf.assign(mse_max, tf.maximum(mse_max, tf.reduce_max(sample_mse))))
+            sample_num = tf.maximum(tf.cast(tf.reduce_sum(hist), tf.float32), 1.0)
+            cdf = tf.cumsum(tf.cast(hist, tf.float32)) / sample_num
+            quantiles = tf.constant(percentiles, tf.float32) / 100
+            bin_idx = tf.argmax(tf.cast(cdf[tf.newaxis, :] >= quantiles[:, tf.newaxis], tf.int32), axis=1)
+            bin_width = (log_range[1] - log_range[0]) / bin_num
+            mse_percentile = tf.pow(10.0, log_range[0] + (tf.cast(bin_idx, tf.float32) + 0.5) * bin_width)
+            mse_percentile = tf.clip_by_value(mse_percentile, mse_min, mse_max)
+            out_frac = tf.cast(out_of_range, tf.float32) / sample_num
+            clamped = tf.logical_or(quantiles <= out_frac[0], quantiles > 1 - out_frac[1])
+            mse_percentile = tf.where(clamped, tf.fill(tf.shape(mse_percentile), np.nan), mse_percentile)
+
+        metrics = {'mae': mae, 'mse': mse, 'mae_profile': mae_profile, 'mse_profile': mse_profile,
+                   'mse_percentile': mse_percentile, 'mse_min': mse_min, 'mse_max': mse_max,
+                   'mse_out_of_range': tf.reduce_sum(out_of_range)}
+        update_op = tf.group(mae_update, mse_update, mae_profile_update, mse_profile_update, hist_update)
+        return metrics, update_op, sample_mae, sample_mse
+
+    def get_eval_outputs(self):
+        """
+        Get outputs written into files by evaluate()
+        :return: list of (name, tensor), each output is written into test_[name]_[model_name].csv
+        """
+        return [('pred', self.preds)]
 
     def evaluate(self, valid_init_op, ckpt_dir, save_file=os.path.join(os.path.dirname(__file__), 'data'),
-                 model_name=''):
+                 model_name='', write_file=True, percentiles=(50, 90, 99), compact=False, half=False):
         """
-        Evaluate the model, and save predictions to save_file
+        Evaluate the model, metrics are accumulated in the session batch by batch, predictions are optionally saved
+        to save_file
         :param valid_init_op: validation dataset init operation
-        :param checkpoint directory
+        :param ckpt_dir: checkpoint directory
         :param save_file: full path to pred file
         :param model_name: name of the model
-        :return:
+        :param write_file: if True, write predictions and truth into csv files
+        :param percentiles: percentiles of the per-sample mean squared error to compute
+        :param compact: if True, load the compact checkpoint, see load()
+        :param half: if True, a compact checkpoint written on the way stores the weights in float16
+        :return: pred file, truth file (None if write_file is False) and a dict of metrics: mae, mse, per-wavelength
+                 mae_profile and mse_profile, mse_percentile, mse_min, mse_max, mse_out_of_range and per-sample
+                 sample_mae and sample_mse
         """
+        metrics, update_op, sample_mae, sample_mse = self.make_metrics(percentiles)
+        outputs = self.get_eval_outputs()
+        pred_file, truth_file = None, None
+        files = []
+        if write_file:
+            files = [os.path.join(save_file, 'test_{}_{}.csv'.format(name, model_name)) for name, _ in outputs]
+            truth_file = os.path.join(save_file, 'test_truth.csv')
+            files.append(truth_file)
+            pred_file = files[0]
+        fetches = [tensor for _, tensor in outputs] + [self.truth] if write_file else []
+
         with tf.Session() as sess:
-            self.load(sess, ckpt_dir)
+            self.load(sess, ckpt_dir, compact=compact, half=half)
             sess.run(valid_init_op)
-            pred_file = os.path.join(save_file, 'test_pred_{}.csv'.format(model_name))
-            truth_file = os.path.join(save_file, 'test_truth.csv')
-            with open(pred_file, 'w'), open(truth_file, 'w'):
-                pass
+            handles = [open(file, 'w') for file in files]
+            mae_list, mse_list = [], []
             try:
                 while True:
-                    with open(pred_file, 'a') as f1, open(truth_file, 'a') as f2:
-                        pred, truth = sess.run([self.logits, self.labels])
-                        np.savetxt(f1, pred, fmt='%.2f')
-                        np.savetxt(f2, truth, fmt='%.2f')
+                    _, mae_val, mse_val, vals = sess.run([update_op, sample_mae, sample_mse, fetches])
+                    mae_list.append(mae_val)
+                    mse_list.append(mse_val)
+                    for f, val in zip(handles, vals):
+                        np.savetxt(f, val, fmt='%.2f')
             except tf.errors.OutOfRangeError:
-                return pred_file, truth_file
                 pass
+            finally:
+                for f in handles:
+                    f.close()
+            metric_vals = sess.run(metrics)
+        metric_vals['mse_percentile'] = dict(zip(percentiles, metric_vals['mse_percentile']))
+        metric_vals['sample_mae'] = np.concatenate(mae_list)
+        metric_vals['sample_mse'] = np.concatenate(mse_list)
+        return pred_file, truth_file, metric_vals
+
+
+class EnsembleNetwork(CnnNetwork):
+    def __init__(self, features, labels, model_fn, batch_size, ensemble_size=5, **kwargs):
+        """
+        Initialize an ensemble of ensemble_size model_fn instances in one graph, all members share the input
+        pipeline and are evaluated in the same forward pass
+        :param features: input features
+        :param labels: input labels
+        :param model_fn: model definition function, can be customized by user
+        :param batch_size: batch size
+        :param ensemble_size: #members in the ensemble
+        :param kwargs: other parameters of CnnNetwork
+        """
+        self.ensemble_size = ensemble_size
+        self.member_logits = None
+        self.logits_std = None
+        super(EnsembleNetwork, self).__init__(features, labels, model_fn, batch_size, **kwargs)
+
+    def create_graph(self, seed=None):
+        """
+        Create one model graph for each member, the members are initialized differently
+        :param seed: random seed of the first member, the others use the following seeds, default to self.seed
+        :return: mean of the member outputs, their standard deviation is stored in self.logits_std
+        """
+        seed = self.seed if seed is None else seed
+        member_logits = []
+        for cnt in range(self.ensemble_size):
+            with tf.variable_scope('member{}'.format(cnt)):
+                member_seed = None if seed is None else seed + cnt
+                member_logits.append(super(EnsembleNetwork, self).create_graph(member_seed))
+        self.member_logits = tf.stack(member_logits, axis=0)
+        logits_mean, logits_var = tf.nn.moments(self.member_logits, axes=[0])
+        self.logits_std = tf.sqrt(logits_var)
+        return logits_mean
+
+    def make_loss(self):
+        """
+        Make the mean of member losses, each member is trained on its own mean squared error
+        :return: mean squared error averaged over members
+        """
+        with tf.variable_scope('loss'):
+            labels = tf.tile(tf.expand_dims(self.labels, axis=0), [self.ensemble_size, 1, 1])
+            return tf.losses.mean_squared_error(labels, self.member_logits)
+
+    def get_eval_outputs(self):
+        """
+        Get outputs written into files by evaluate(), the standard deviation of the members is written too
+        :return: list of (name, tensor), each output is written into test_[name]_[model_name].csv
+        """
+        return [('pred', self.preds), ('std', self.denormalize(self.logits_std, shift=False))]
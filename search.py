@@ -0,0 +1,196 @@
+import os
+import time
+import argparse
+import numpy as np
+import lazy_loader
+import utils
+import data_reader
+import network_maker
+import network_helper
+tf = lazy_loader.lazy_import('tensorflow')
+
+
+INPUT_SIZE = 2
+OUTPUT_SIZE = 300
+X_RANGE = [0, 1]
+Y_RANGE = [i for i in range(2, 1003)]
+CROSS_VAL = 5
+VAL_FOLD = 0
+BATCH_SIZE = 20
+SHUFFLE_SIZE = 1
+CONFIG_NUM = 27
+MIN_STEP = 100
+MAX_STEP = 2700
+ETA = 3
+DECAY_STEP = 4000
+DECAY_RATE = 0.5
+TRAIN_FILE = 'TrainDataV9.txt'
+VALID_FILE = 'TestDataV9.txt'
+FC_NUM = (2, 5)
+FC_UNITS = (5, 10, 20, 50, 100, 200, 500)
+TCONV_NUM = (0, 3)
+TCONV_FILTERS = (1, 4, 8, 16)
+LEARN_RATE_RANGE = (1e-4, 1e-2)
+RAND_SEED = 1234
+
+
+def read_flag():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-size', type=int, default=INPUT_SIZE, help='input size')
+    parser.add_argument('--output-size', type=int, default=OUTPUT_SIZE,
+                        help='dimensionality of the output, shared by all sampled architectures')
+    parser.add_argument('--x-range', type=list, default=X_RANGE, help='columns of input parameters')
+    parser.add_argument('--y-range', type=list, default=Y_RANGE, help='columns of output parameters')
+    parser.add_argument('--cross-val', type=int, default=CROSS_VAL, help='# cross validation folds')
+    parser.add_argument('--val-fold', type=int, default=VAL_FOLD, help='fold to be used for validation')
+    parser.add_argument('--batch-size', default=BATCH_SIZE, type=int, help='batch size (100)')
+    parser.add_argument('--shuffle-size', default=SHUFFLE_SIZE, type=int, help='shuffle size (100)')
+    parser.add_argument('--config-num', default=CONFIG_NUM, type=int,
+                        help='# configurations sampled in successive halving')
+    parser.add_argument('--min-step', default=MIN_STEP, type=int, help='# steps to train in the first rung')
+    parser.add_argument('--max-step', default=MAX_STEP, type=int, help='max # steps to train any configuration')
+    parser.add_argument('--eta', default=ETA, type=int, help='keep 1/eta of the configurations at each rung')
+    parser.add_argument('--hyperband', action='store_true',
+                        help='run hyperband brackets instead of a single successive halving')
+    parser.add_argument('--decay-step', default=DECAY_STEP, type=int,
+                        help='decay learning rate at this number of steps')
+    parser.add_argument('--decay-rate', default=DECAY_RATE, type=float,
+                        help='decay learn rate by multiplying this factor')
+    parser.add_argument('--upsample-mode', default='tconv', type=str, choices=utils.UPSAMPLE_MODES,
+                        help='upsampling block used in the model function')
+    parser.add_argument('--shared-dir', default=None, type=str,
+                        help='attach to the data published in this directory by data_server.py')
+    parser.add_argument('--train-file', default=TRAIN_FILE, type=str, help='name of the training file')
+    parser.add_argument('--valid-file', default=VALID_FILE, type=str, help='name of the validation file')
+    parser.add_argument('--rand-seed', default=RAND_SEED, type=int,
+                        help='random seed of the sampler, the data pipeline and the models')
+
+    flags = parser.parse_args()
+    return flags
+
+
+def sample_config(rng, output_size):
+    """
+    Sample an architecture and a learning rate, upsampling sizes are chained so that up_size%feature_dim == 0
+    :param rng: np.random.RandomState used for sampling
+    :param output_size: dimensionality of the output
+    :return: a dict of fc_filters, tconv_dims, tconv_filters and learn_rate
+    """
+    divisors = [d for d in range(1, output_size+1) if output_size % d == 0]
+    tconv_num = rng.randint(TCONV_NUM[0], TCONV_NUM[1]+1)
+    fc_filters = list(rng.choice(FC_UNITS, rng.randint(FC_NUM[0], FC_NUM[1]+1) - 1))
+    if tconv_num == 0:
+        fc_filters.append(output_size)
+        tconv_dims = []
+    else:
+        # last fc layer and every upsampling layer except the last one upsample by an integer factor
+        fc_filters.append(rng.choice([d for d in divisors if d < output_size]))
+        tconv_dims = []
+        feature_dim = fc_filters[-1]
+        for _ in range(tconv_num - 1):
+            candidates = [d for d in divisors if feature_dim <= d < output_size and d % feature_dim == 0]
+            feature_dim = rng.choice(candidates)
+            tconv_dims.append(feature_dim)
+        tconv_dims.append(output_size)
+    tconv_filters = list(rng.choice(TCONV_FILTERS, tconv_num))
+    learn_rate = np.exp(rng.uniform(np.log(LEARN_RATE_RANGE[0]), np.log(LEARN_RATE_RANGE[1])))
+    return {'fc_filters': tuple(int(a) for a in fc_filters), 'tconv_dims': tuple(int(a) for a in tconv_dims),
+            'tconv_filters': tuple(int(a) for a in tconv_filters), 'learn_rate': learn_rate}
+
+
+def train_config(flags, reader, config, ckpt_dir, step_num, rung, restore_dir=None):
+    """
+    Train a configuration for step_num steps and validate it at the end
+    :param flags: flags returned by read_flag()
+    :param reader: data reader
+    :param config: configuration returned by sample_config()
+    :param ckpt_dir: checkpoint directory of this configuration
+    :param step_num: number of steps to train
+    :param rung: index of the rung in successive halving
+    :param restore_dir: if it's not none, continue training from the checkpoint in this directory
+    :return: validation loss, directory of the new checkpoint
+    """
+    tf.reset_default_graph()
+    # every configuration in a rung sees the same sequence of batches, a configuration resumed in the next rung
+    # continues on new batches
+    reader.reset_rng(utils.layer_seed(flags.rand_seed, 'rung{}'.format(rung)))
+    features, labels, train_init_op, valid_init_op = reader.get_data_holder_and_init_op(
+        (flags.train_file, flags.valid_file))
+    ntwk = network_maker.CnnNetwork(features, labels, utils.my_model_fn, flags.batch_size,
+                                    fc_filters=config['fc_filters'], tconv_dims=config['tconv_dims'],
+                                    tconv_filters=config['tconv_filters'], learn_rate=config['learn_rate'],
+                                    decay_step=flags.decay_step, decay_rate=flags.decay_rate, ckpt_dir=ckpt_dir,
+                                    upsample_mode=flags.upsample_mode, seed=flags.rand_seed)
+    # validate once, after the last step of the rung
+    valid_hook = network_helper.ValidationHook(max(step_num - 1, 1), valid_init_op, ntwk.labels, ntwk.logits,
+                                               ntwk.loss)
+    ntwk.train(train_init_op, max(step_num, 2), [valid_hook], restore_dir=restore_dir)
+    return valid_hook.loss_record[-1][1], ntwk.ckpt_dir
+
+
+def successive_halving(flags, reader, search_dir, config_num, min_step, max_step, rng):
+    """
+    Sample configurations and train them in rungs with eta times more steps each, only the best 1/eta of the
+    configurations is promoted to the next rung
+    :param flags: flags returned by read_flag()
+    :param reader: data reader
+    :param search_dir: directory where checkpoints of the configurations are stored
+    :param config_num: # configurations in the first rung
+    :param min_step: # steps to train in the first rung
+    :param max_step: max # steps to train any configuration
+    :param rng: np.random.RandomState used for sampling
+    :return: list of (config, total steps trained, validation loss) of every configuration when it was stopped
+    """
+    configs = [sample_config(rng, flags.output_size) for _ in range(config_num)]
+    alive = [{'id': i, 'config': c, 'ckpt': None, 'step': 0, 'loss': np.inf} for i, c in enumerate(configs)]
+    result = []
+    rung_step, rung = min_step, 0
+    while len(alive) > 0:
+        for trial in alive:
+            loss, trial['ckpt'] = train_config(flags, reader, trial['config'],
+                                               os.path.join(search_dir, 'config{}'.format(trial['id'])),
+                                               rung_step - trial['step'], rung, restore_dir=trial['ckpt'])
+            trial['step'], trial['loss'] = rung_step, loss
+            print('config {}: {}, step {}, loss: {:.3f}'.format(trial['id'], trial['config'], rung_step, loss))
+        alive = sorted(alive, key=lambda a: a['loss'])
+        keep_num = len(alive) // flags.eta if rung_step * flags.eta <= max_step else 0
+        result.extend([(a['config'], a['step'], a['loss']) for a in alive[keep_num:]])
+        alive = alive[:keep_num]
+        rung_step *= flags.eta
+        rung += 1
+    return result
+
+
+def main(flags):
+    reader = data_reader.DataReader(input_size=flags.input_size, output_size=flags.output_size,
+                                    x_range=flags.x_range, y_range=flags.y_range, cross_val=flags.cross_val,
+                                    val_fold=flags.val_fold, batch_size=flags.batch_size,
+                                    shuffle_size=flags.shuffle_size, shared_dir=flags.shared_dir,
+                                    rand_seed=flags.rand_seed)
+    search_dir = os.path.join(os.path.dirname(__file__), 'models',
+                              'search_{}'.format(time.strftime('%Y%m%d_%H%M%S', time.gmtime())))
+    rng = np.random.RandomState(flags.rand_seed)
+
+    if flags.hyperband:
+        # each bracket trades #configurations against #steps in the first rung
+        s_max = int(np.log(flags.max_step / flags.min_step) / np.log(flags.eta) + 1e-6)
+        result = []
+        for s in range(s_max, -1, -1):
+            config_num = int(np.ceil((s_max + 1) / (s + 1) * flags.eta ** s))
+            min_step = int(flags.max_step / flags.eta ** s)
+            result.extend(successive_halving(flags, reader, os.path.join(search_dir, 'bracket{}'.format(s)),
+                                             config_num, min_step, flags.max_step, rng))
+    else:
+        result = successive_halving(flags, reader, search_dir, flags.config_num, flags.min_step, flags.max_step,
+                                    rng)
+
+    result = sorted(result, key=lambda a: (-a[1], a[2]))
+    with open(os.path.join(search_dir, 'search_result.txt'), 'w') as f:
+        for config, step, loss in result:
+            f.write('step: {}, loss: {:.6f}, config: {}\n'.format(step, loss, config))
+    print('Best config: {}, loss: {:.3f}'.format(result[0][0], result[0][2]))
+
+
+if __name__ == '__main__':
+    flags = read_flag()
+    main(flags)
@@ -0,0 +1,302 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import collections
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+import lazy_loader
+import utils
+import network_maker
+import network_helper
+tf = lazy_loader.lazy_import('tensorflow')
+
+
+INPUT_SIZE = 2
+BATCH_SIZE = 20
+HOST = '127.0.0.1'
+PORT = 8500
+MAX_LATENCY = 5
+LATENCY_WINDOW = 10000
+
+
+def read_flag():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-size', type=int, default=INPUT_SIZE, help='input size')
+    parser.add_argument('--batch-size', default=BATCH_SIZE, type=int,
+                        help='# rows run in one session run, smaller batches are padded to this size')
+    parser.add_argument('--max-latency', default=MAX_LATENCY, type=float,
+                        help='max # milliseconds a request waits for other requests to fill the batch')
+    parser.add_argument('--model-name', default=None, type=str, help='name of the model, default to the latest one')
+    parser.add_argument('--compact', action='store_true',
+                        help='load the compact checkpoint of the model, write it from the full one if it is missing')
+    parser.add_argument('--host', default=HOST, type=str, help='address to listen on')
+    parser.add_argument('--port', default=PORT, type=int, help='port to listen on')
+
+    flags = parser.parse_args()
+    return flags
+
+
+class PredictRequest(object):
+    """
+    Input rows of one client request, the batcher fills in the outputs and sets done
+    """
+    def __init__(self, features):
+        self.features = features
+        self.outputs = None
+        self.error = None
+        self.done = threading.Event()
+        self.start_time = time.time()
+
+
+class Batcher(object):
+    """
+    Coalesce concurrent requests into batches of batch_size rows and run them in one warm session
+    A batch is run as soon as it is full or max_latency seconds after its first request arrived
+    """
+    def __init__(self, sess, features, outputs, batch_size, max_latency, latency_window=LATENCY_WINDOW):
+        """
+        Initialize the batcher
+        :param sess: session with the model loaded
+        :param features: input placeholder of shape [batch_size, input_size]
+        :param outputs: list of (name, tensor) to return for every row
+        :param batch_size: # rows of the placeholder
+        :param max_latency: max # seconds to wait for a batch to fill
+        :param latency_window: # most recent requests the latency percentiles are computed over
+        """
+        self.sess = sess
+        self.features = features
+        self.names = [name for name, _ in outputs]
+        self.outputs = [tensor for _, tensor in outputs]
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latency = collections.deque(maxlen=latency_window)
+        self.request_num = 0
+        self.row_num = 0
+        self.batch_num = 0
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def predict(self, features):
+        """
+        Queue rows for prediction and wait for the result, called from the request threads
+        :param features: array of shape [#rows, input_size]
+        :return: a dict of output name to array of shape [#rows, output_size]
+        """
+        if features.shape[0] == 0:
+            return {name: np.zeros([0] + tensor.get_shape().as_list()[1:], np.float32)
+                    for name, tensor in zip(self.names, self.outputs)}
+        request = PredictRequest(features)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.outputs
+
+    def collect(self):
+        """
+        Block until a request arrives, then keep collecting until batch_size rows are queued or max_latency passed since
+        the first request arrived, a request that waited through the previous run is not held for another window
+        :return: list of requests
+        """
+        requests = [self.queue.get()]
+        row_num = requests[0].features.shape[0]
+        deadline = requests[0].start_time + self.max_latency
+        while row_num < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            requests.append(request)
+            row_num += request.features.shape[0]
+        return requests
+
+    def run(self):
+        """
+        Batcher loop, rows of the collected requests are run in chunks of batch_size, the last one padded with zeros
+        :return:
+        """
+        while True:
+            requests = self.collect()
+            batch_num = 0
+            try:
+                features = np.concatenate([r.features for r in requests], axis=0)
+                row_num = features.shape[0]
+                pad_num = -row_num % self.batch_size
+                features = np.concatenate([features, np.zeros((pad_num, features.shape[1]), features.dtype)])
+                vals = [[] for _ in self.outputs]
+                for start in range(0, features.shape[0], self.batch_size):
+                    batch_vals = self.sess.run(self.outputs,
+                                               feed_dict={self.features: features[start:start+self.batch_size]})
+                    for val_list, val in zip(vals, batch_vals):
+                        val_list.append(val)
+                    batch_num += 1
+                vals = [np.concatenate(val_list)[:row_num] for val_list in vals]
+                start = 0
+                for r in requests:
+                    end = start + r.features.shape[0]
+                    r.outputs = {name: val[start:end] for name, val in zip(self.names, vals)}
+                    start = end
+            except Exception as e:
+                for r in requests:
+                    r.error = e
+            end_time = time.time()
+            with self.lock:
+                self.request_num += len(requests)
+                self.row_num += sum(r.features.shape[0] for r in requests)
+                self.batch_num += batch_num
+                self.latency.extend(end_time - r.start_time for r in requests)
+            for r in requests:
+                r.done.set()
+
+    def get_stats(self):
+        """
+        Get latency percentiles over the latest requests and throughput since the batcher was started
+        :return: a dict of counters
+        """
+        with self.lock:
+            latency = np.array(self.latency) * 1e3
+            uptime = time.time() - self.start_time
+            return {'requests': self.request_num, 'rows': self.row_num, 'batches': self.batch_num,
+                    'uptime_s': uptime,
+                    'requests_per_s': self.request_num / uptime, 'rows_per_s': self.row_num / uptime,
+                    'latency_p50_ms': float(np.percentile(latency, 50)) if len(latency) else None,
+                    'latency_p99_ms': float(np.percentile(latency, 99)) if len(latency) else None}
+
+
+class PredictServer(ThreadingHTTPServer):
+    """
+    HTTP server with one thread per connection and a listen backlog deep enough for bursts of concurrent clients
+    """
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_handler(batcher, input_size):
+    """
+    Make the request handler class bound to a batcher
+    POST /predict with {"features": [[x0, x1, ...], ...]} returns {"pred": [[...], ...]} (and "std" for ensembles)
+    GET /stats returns the counters of the batcher
+    :param batcher: batcher running the model
+    :param input_size: # input parameters of every row
+    :return: a BaseHTTPRequestHandler subclass
+    """
+    class PredictHandler(BaseHTTPRequestHandler):
+        def send_json(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, batcher.get_stats())
+            else:
+                self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                features = np.array(body['features'], dtype=np.float32)
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {'error': 'bad request: {}'.format(e)})
+                return
+            if features.shape == (0,):
+                features = features.reshape(0, input_size)
+            if features.ndim != 2 or features.shape[1] != input_size:
+                self.send_json(400, {'error': 'bad request: features should be a list of rows of {} input parameters, '
+                                              'got shape {}'.format(input_size, list(features.shape))})
+                return
+            try:
+                outputs = batcher.predict(features)
+            except Exception as e:
+                self.send_json(500, {'error': 'prediction failed: {}'.format(e)})
+                return
+            self.send_json(200, {name: val.tolist() for name, val in outputs.items()})
+
+        def log_message(self, format, *args):
+            pass
+
+    return PredictHandler
+
+
+def request_predict(features, host=HOST, port=PORT):
+    """
+    Client helper for other tools, get predictions of the server for some rows
+    :param features: array-like of shape [#rows, input_size]
+    :param host: address of the server
+    :param port: port of the server
+    :return: a dict of output name to array of shape [#rows, output_size]
+    """
+    data = json.dumps({'features': np.asarray(features).tolist()}).encode('utf-8')
+    request = Request('http://{}:{}/predict'.format(host, port), data=data,
+                      headers={'Content-Type': 'application/json'})
+    with urlopen(request) as response:
+        return {name: np.array(val) for name, val in json.loads(response.read().decode('utf-8')).items()}
+
+
+def main(flags):
+    models_dir = os.path.join(os.path.dirname(__file__), 'models')
+    if flags.model_name is None:
+        ckpt_dir = network_helper.get_latest_model(models_dir)
+    else:
+        ckpt_dir = os.path.join(models_dir, flags.model_name)
+    fc_filters, tconv_dims, tconv_filters = network_helper.get_parameters(ckpt_dir)
+    upsample_mode = network_helper.get_parameter(ckpt_dir, 'upsample_mode', default='tconv')
+    ensemble_size = int(network_helper.get_parameter(ckpt_dir, 'ensemble_size', default=1))
+    gradient_checkpoint = network_helper.get_parameter(ckpt_dir, 'gradient_checkpoint') == 'True'
+    norm_stats = network_helper.get_norm_stats(ckpt_dir)
+    output_size = fc_filters[-1] if len(tconv_dims) == 0 else tconv_dims[-1]
+
+    # the graph is built for a fixed batch size, labels are only needed to build the loss
+    features = tf.placeholder(tf.float32, [flags.batch_size, flags.input_size], name='features')
+    labels = tf.zeros([flags.batch_size, output_size])
+    # requests carry raw input parameters, normalize them the way the data reader did in training
+    model_features = features
+    if norm_stats is not None:
+        model_features = (features - norm_stats['x_mean'].astype(np.float32)) / norm_stats['x_std'].astype(np.float32)
+    if ensemble_size > 1:
+        ntwk = network_maker.EnsembleNetwork(model_features, labels, utils.my_model_fn, flags.batch_size,
+                                             ensemble_size=ensemble_size, fc_filters=fc_filters,
+                                             tconv_dims=tconv_dims, tconv_filters=tconv_filters,
+                                             make_folder=False, upsample_mode=upsample_mode,
+                                             gradient_checkpoint=gradient_checkpoint, norm_stats=norm_stats)
+    else:
+        ntwk = network_maker.CnnNetwork(model_features, labels, utils.my_model_fn, flags.batch_size,
+                                        fc_filters=fc_filters, tconv_dims=tconv_dims,
+                                        tconv_filters=tconv_filters, make_folder=False,
+                                        upsample_mode=upsample_mode, gradient_checkpoint=gradient_checkpoint,
+                                        norm_stats=norm_stats)
+
+    with tf.Session() as sess:
+        ntwk.load(sess, ckpt_dir, compact=flags.compact)
+        tf.get_default_graph().finalize()
+        batcher = Batcher(sess, features, ntwk.get_eval_outputs(), flags.batch_size, flags.max_latency / 1e3)
+        server = PredictServer((flags.host, flags.port), make_handler(batcher, flags.input_size))
+        print('Serving {} on http://{}:{}'.format(os.path.basename(ckpt_dir), flags.host, flags.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            print(json.dumps(batcher.get_stats()))
+
+
+if __name__ == '__main__':
+    flags = read_flag()
+    main(flags)
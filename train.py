@@ -1,9 +1,11 @@
+import os
 import argparse
-import tensorflow as tf
+import lazy_loader
 import utils
 import data_reader
 import network_maker
 import network_helper
+tf = lazy_loader.lazy_import('tensorflow')
 
 
 INPUT_SIZE = 2
@@ -22,8 +24,20 @@ TRAIN_STEP = 6000
 LEARN_RATE = 1e-4
 DECAY_STEP = 4000
 DECAY_RATE = 0.5
+LR_SCHEDULE = 'exp_decay'
+WARMUP_STEP = 0
+MIN_LEARN_RATE = 0.0
+PLATEAU_PATIENCE = 3
+PLATEAU_FACTOR = 0.5
 TRAIN_FILE = 'TrainDataV9.txt'
 VALID_FILE = 'TestDataV9.txt'
+UPSAMPLE_MODE = 'tconv'
+FINETUNE_STEP = 500
+REPLAY_RATIO = 0.5
+ENSEMBLE_SIZE = 1
+ERROR_INDEX = None
+HARD_RATIO = 0.5
+RAND_SEED = 1234
 
 
 def read_flag():
@@ -48,6 +62,41 @@ def read_flag():
                         help='decay learning rate at this number of steps')
     parser.add_argument('--decay-rate', default=DECAY_RATE, type=float,
                         help='decay learn rate by multiplying this factor')
+    parser.add_argument('--lr-schedule', default=LR_SCHEDULE, type=str, choices=network_maker.LR_SCHEDULES,
+                        help='learning rate schedule')
+    parser.add_argument('--warmup-step', default=WARMUP_STEP, type=int,
+                        help='# steps of linear learning rate warm up, peak of the one_cycle schedule')
+    parser.add_argument('--min-learn-rate', default=MIN_LEARN_RATE, type=float,
+                        help='final learning rate of the cosine and one_cycle schedules')
+    parser.add_argument('--plateau-patience', default=PLATEAU_PATIENCE, type=int,
+                        help='# evaluations without improvement before reducing the learning rate (plateau)')
+    parser.add_argument('--plateau-factor', default=PLATEAU_FACTOR, type=float,
+                        help='reduce the learning rate by multiplying this factor (plateau)')
+    parser.add_argument('--upsample-mode', default=UPSAMPLE_MODE, type=str, choices=utils.UPSAMPLE_MODES,
+                        help='upsampling block used in the model function')
+    parser.add_argument('--gradient-checkpoint', action='store_true',
+                        help='recompute activations of the upsampling layers in the backward pass to save memory')
+    parser.add_argument('--normalize', action='store_true',
+                        help='standardize features and labels with the statistics of the training file')
+    parser.add_argument('--compact', action='store_true',
+                        help='also save a compact checkpoint with trainable weights only for inference')
+    parser.add_argument('--half-precision', action='store_true', help='store the compact checkpoint in float16')
+    parser.add_argument('--ensemble-size', default=ENSEMBLE_SIZE, type=int,
+                        help='train an ensemble of this many models in one graph if larger than 1')
+    parser.add_argument('--incremental', action='store_true',
+                        help='fine-tune the latest model on rows appended to the training file since it was trained')
+    parser.add_argument('--finetune-step', default=FINETUNE_STEP, type=int,
+                        help='# steps to fine-tune in incremental mode')
+    parser.add_argument('--replay-ratio', default=REPLAY_RATIO, type=float,
+                        help='fraction of replayed old rows in the training data in incremental mode')
+    parser.add_argument('--error-index', default=ERROR_INDEX, type=str,
+                        help='name of an error index written by evaluate.py, oversample rows where it errs most')
+    parser.add_argument('--hard-ratio', default=HARD_RATIO, type=float,
+                        help='fraction of the sampling probability assigned by the error index')
+    parser.add_argument('--rand-seed', default=RAND_SEED, type=int,
+                        help='random seed of the data pipeline and of the model initialization')
+    parser.add_argument('--shared-dir', default=None, type=str,
+                        help='attach to the data published in this directory by data_server.py')
     parser.add_argument('--train-file', default=TRAIN_FILE, type=str, help='name of the training file')
     parser.add_argument('--valid-file', default=VALID_FILE, type=str, help='name of the validation file')
 
@@ -56,32 +105,85 @@ def read_flag():
 
 
 def main(flags):
+    fc_filters, tconv_dims, tconv_filters = flags.fc_filters, flags.tconv_dims, flags.tconv_filters
+    upsample_mode, ensemble_size = flags.upsample_mode, flags.ensemble_size
+    gradient_checkpoint = flags.gradient_checkpoint
+    restore_dir, new_row_start, train_step = None, None, flags.train_step
+    norm_stats = None
+    if flags.incremental:
+        # reuse the architecture of the latest model and only train on top of it
+        restore_dir = network_helper.get_latest_model(os.path.join(os.path.dirname(__file__), 'models'))
+        if restore_dir is None:
+            raise ValueError('No trained model found for incremental training')
+        fc_filters, tconv_dims, tconv_filters = network_helper.get_parameters(restore_dir)
+        upsample_mode = network_helper.get_parameter(restore_dir, 'upsample_mode', default='tconv')
+        ensemble_size = int(network_helper.get_parameter(restore_dir, 'ensemble_size', default=1))
+        gradient_checkpoint = network_helper.get_parameter(restore_dir, 'gradient_checkpoint') == 'True'
+        data_rows = network_helper.get_parameter(restore_dir, 'data_rows', default='None')
+        new_row_start = 0 if data_rows == 'None' else int(data_rows)
+        # keep normalizing with the statistics the model was trained with
+        norm_stats = network_helper.get_norm_stats(restore_dir)
+        train_step = flags.finetune_step
+
     # initialize data reader
-    if len(flags.tconv_dims) == 0:
-        output_size = flags.fc_filters[-1]
+    if len(tconv_dims) == 0:
+        output_size = fc_filters[-1]
     else:
-        output_size = flags.tconv_dims[-1]
+        output_size = tconv_dims[-1]
     reader = data_reader.DataReader(input_size=flags.input_size, output_size=output_size,
                                     x_range=flags.x_range, y_range=flags.y_range, cross_val=flags.cross_val,
                                     val_fold=flags.val_fold, batch_size=flags.batch_size,
-                                    shuffle_size=flags.shuffle_size)
+                                    shuffle_size=flags.shuffle_size, new_row_start=new_row_start,
+                                    replay_ratio=flags.replay_ratio, error_index_file=flags.error_index,
+                                    hard_ratio=flags.hard_ratio, shared_dir=flags.shared_dir,
+                                    rand_seed=flags.rand_seed, normalize=flags.normalize and not flags.incremental,
+                                    norm_stats=norm_stats)
+    data_rows = reader.get_row_num(flags.train_file)
+    if flags.incremental:
+        if data_rows <= new_row_start:
+            print('No new rows in {} since {} was trained'.format(flags.train_file, restore_dir))
+            return
+        print('Fine-tuning {} on {} new rows'.format(restore_dir, data_rows - new_row_start))
     features, labels, train_init_op, valid_init_op = reader.get_data_holder_and_init_op(
         (flags.train_file, flags.valid_file))
 
     # make network
-    ntwk = network_maker.CnnNetwork(features, labels, utils.my_model_fn, flags.batch_size,
-                                    fc_filters=flags.fc_filters, tconv_dims=flags.tconv_dims,
-                                    tconv_filters=flags.tconv_filters, learn_rate=flags.learn_rate,
-                                    decay_step=flags.decay_step, decay_rate=flags.decay_rate)
+    if ensemble_size > 1:
+        ntwk = network_maker.EnsembleNetwork(features, labels, utils.my_model_fn, flags.batch_size,
+                                             ensemble_size=ensemble_size, fc_filters=fc_filters,
+                                             tconv_dims=tconv_dims, tconv_filters=tconv_filters,
+                                             learn_rate=flags.learn_rate, decay_step=flags.decay_step,
+                                             decay_rate=flags.decay_rate, upsample_mode=upsample_mode,
+                                             data_rows=data_rows, gradient_checkpoint=gradient_checkpoint,
+                                             lr_schedule=flags.lr_schedule, total_step=train_step,
+                                             warmup_step=flags.warmup_step, min_learn_rate=flags.min_learn_rate,
+                                             seed=flags.rand_seed, norm_stats=reader.norm_stats)
+    else:
+        ntwk = network_maker.CnnNetwork(features, labels, utils.my_model_fn, flags.batch_size,
+                                        fc_filters=fc_filters, tconv_dims=tconv_dims,
+                                        tconv_filters=tconv_filters, learn_rate=flags.learn_rate,
+                                        decay_step=flags.decay_step, decay_rate=flags.decay_rate,
+                                        upsample_mode=upsample_mode, data_rows=data_rows,
+                                        gradient_checkpoint=gradient_checkpoint, lr_schedule=flags.lr_schedule,
+                                        total_step=train_step, warmup_step=flags.warmup_step,
+                                        min_learn_rate=flags.min_learn_rate, seed=flags.rand_seed,
+                                        norm_stats=reader.norm_stats)
     # define hooks for monitoring training
     train_hook = network_helper.TrainValueHook(flags.verb_step, ntwk.loss,
                                                ckpt_dir=ntwk.ckpt_dir, write_summary=True)
     lr_hook = network_helper.TrainValueHook(flags.verb_step, ntwk.learn_rate, ckpt_dir=ntwk.ckpt_dir,
                                             write_summary=True, value_name='learning_rate')
-    valid_hook = network_helper.ValidationHook(flags.eval_step, valid_init_op, ntwk.labels, ntwk.logits, ntwk.loss,
-                                               ckpt_dir=ntwk.ckpt_dir, write_summary=True)
+    if ntwk.lr_scale is not None:
+        lr_plateau = network_helper.ReduceLROnPlateau(ntwk.lr_scale, factor=flags.plateau_factor,
+                                                      patience=flags.plateau_patience)
+    else:
+        lr_plateau = None
+    # validate in the scale of the data, so that runs with and without --normalize can be compared
+    valid_hook = network_helper.ValidationHook(flags.eval_step, valid_init_op, ntwk.truth, ntwk.preds, ntwk.data_mse,
+                                               ckpt_dir=ntwk.ckpt_dir, write_summary=True, lr_plateau=lr_plateau)
     # train the network
-    ntwk.train(train_init_op, flags.train_step, [train_hook, valid_hook, lr_hook], write_summary=True)
+    ntwk.train(train_init_op, train_step, [train_hook, valid_hook, lr_hook], write_summary=True,
+               restore_dir=restore_dir, compact=flags.compact, half=flags.half_precision)
 
 
 if __name__ == '__main__':
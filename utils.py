@@ -1,9 +1,7 @@
-import tensorflow as tf
+import zlib
 import numpy as np
-from tensorflow.python.framework import ops
-from tensorflow.python.framework import tensor_shape
-from tensorflow.python.ops import array_ops
-from tensorflow.python.ops import gen_nn_ops
+import lazy_loader
+tf = lazy_loader.lazy_import('tensorflow')
 
 
 def conv1d_transpose(
@@ -40,6 +38,11 @@ def conv1d_transpose(
     ValueError: If input/output depth does not match `filter`'s shape, or if
       padding is other than `'VALID'` or `'SAME'`.
   """
+  from tensorflow.python.framework import ops
+  from tensorflow.python.framework import tensor_shape
+  from tensorflow.python.ops import array_ops
+  from tensorflow.python.ops import gen_nn_ops
+
   with ops.name_scope(name, "conv1d_transpose",
                       [value, filter, output_shape]) as name:
     output_shape_ = ops.convert_to_tensor(output_shape, name="output_shape")
@@ -99,11 +102,23 @@ def conv1d_transpose(
     return array_ops.squeeze(result, [spatial_start_dim])
 
 
-def linear(input_, output_size, scope=None, stddev=0.02, bias_start=0.0, with_w=False):
+def layer_seed(seed, name):
+    """
+    Derive the random seed of a layer from the random seed of the model, so that layers are initialized differently
+    :param seed: random seed of the model, None for an unseeded initialization
+    :param name: name of the layer
+    :return: random seed of the layer
+    """
+    if seed is None:
+        return None
+    return (seed + zlib.crc32(name.encode())) % (2**31 - 1)
+
+
+def linear(input_, output_size, scope=None, stddev=0.02, bias_start=0.0, with_w=False, seed=None):
     shape = input_.get_shape().as_list()
     with tf.variable_scope(scope or 'Linear'):
         matrix = tf.get_variable('Matrix', [shape[1], output_size], tf.float32,
-                                 tf.random_normal_initializer(stddev=stddev))
+                                 tf.random_normal_initializer(stddev=stddev, seed=seed))
         bias = tf.get_variable('bias', [output_size],
             initializer=tf.constant_initializer(bias_start))
         if with_w:
@@ -112,89 +127,167 @@ def linear(input_, output_size, scope=None, stddev=0.02, bias_start=0.0, with_w=
             return tf.matmul(input_, matrix) + bias
 
 
-def my_model_fn(features, batch_size, fc_filters, tconv_dims, tconv_filters):
+UPSAMPLE_MODES = ('tconv', 'tconv2d', 'resize_conv')
+
+
+def upsample_layer(up, cnt, batch_size, up_size, up_filter, last_filter, stride, upsample_mode='tconv',
+                   conv_up=False, get_variable=False, seed=None):
     """
-    My customized model function
-    :param features: input features
-    :param output_size: dimension of output data
-    :return:
+    One upsampling layer of upsample_stack()
+    :param up: input of the layer, [batch, width, channel] for 'tconv' and [batch, 1, width, channel] otherwise
+    :param cnt: index of the layer
+    :param batch_size: batch size
+    :param up_size: dimensionality of data after this layer
+    :param up_filter: #filters of this layer
+    :param last_filter: #filters of the previous layer
+    :param stride: upsampling factor
+    :param upsample_mode: upsampling block to use, one of UPSAMPLE_MODES
+    :param conv_up: if True, add a conv layer with leaky relu after the upsampling
+    :param get_variable: if True, create the filter with tf.get_variable so that it can be reused in a variable scope
+    :param seed: random seed of the model
+    :return: output of the layer
     """
-    fc = features
-    for cnt, filters in enumerate(fc_filters):
-        fc = tf.layers.dense(inputs=fc, units=filters, activation=tf.nn.leaky_relu, name='fc{}'.format(cnt),
-                             kernel_initializer=tf.random_normal_initializer(stddev=0.02))
-    up = tf.expand_dims(fc, axis=2)
-    feature_dim = fc_filters[-1]
+    def make_filter(shape):
+        if get_variable:
+            return tf.get_variable('filter', shape,
+                                   initializer=tf.random_normal_initializer(seed=layer_seed(seed, 'up{}'.format(cnt))))
+        return tf.Variable(tf.random_normal(shape, seed=layer_seed(seed, 'up{}'.format(cnt))))
+
+    if upsample_mode == 'tconv':
+        f = make_filter([3, up_filter, last_filter])
+        up = conv1d_transpose(up, f, [batch_size, up_size, up_filter], stride, name='up{}'.format(cnt))
+        if conv_up:
+            up = tf.layers.conv1d(up, up_filter, 3, activation=tf.nn.leaky_relu, name='conv_up{}'.format(cnt),
+                                  padding='same', kernel_initializer=tf.glorot_uniform_initializer(
+                                      seed=layer_seed(seed, 'conv_up{}'.format(cnt))))
+    else:
+        if upsample_mode == 'tconv2d':
+            f = make_filter([1, 3, up_filter, last_filter])
+            up = tf.nn.conv2d_transpose(up, f, [batch_size, 1, up_size, up_filter], [1, 1, stride, 1],
+                                        padding='SAME', name='up{}'.format(cnt))
+        else:
+            up = tf.image.resize_nearest_neighbor(up, [1, up_size], name='resize{}'.format(cnt))
+            f = make_filter([1, 3, last_filter, up_filter])
+            up = tf.nn.conv2d(up, f, [1, 1, 1, 1], padding='SAME', name='up{}'.format(cnt))
+        if conv_up:
+            up = tf.layers.conv2d(up, up_filter, (1, 3), activation=tf.nn.leaky_relu,
+                                  name='conv_up{}'.format(cnt), padding='same',
+                                  kernel_initializer=tf.glorot_uniform_initializer(
+                                      seed=layer_seed(seed, 'conv_up{}'.format(cnt))))
+    return up
+
+
+def upsample_stack(fc, batch_size, tconv_dims, tconv_filters, upsample_mode='tconv', conv_up=False,
+                   gradient_checkpoint=False, seed=None):
+    """
+    Upsample the output of the fully connected layers and squeeze it into a single channel
+    :param fc: output of the last fully connected layer, [batch_size, feature_dim]
+    :param batch_size: batch size
+    :param tconv_dims: dimensionality of data after each upsampling layer
+    :param tconv_filters: #filters at each upsampling layer
+    :param upsample_mode: 'tconv' uses conv1d_transpose, which reshapes the 3-D tensor to 4-D at every layer,
+                          'tconv2d' uses the native conv2d_transpose on a [batch, 1, width, channel] tensor held
+                          through the whole stack, 'resize_conv' uses nearest neighbor resize followed by a conv
+    :param conv_up: if True, add a conv layer with leaky relu after each upsampling layer
+    :param gradient_checkpoint: if True, only the output of each upsampling layer is kept for the backward pass, the
+                                activations inside a layer are recomputed when its gradient is computed
+    :param seed: random seed of the model, None for an unseeded initialization
+    :return: output of the stack, [batch_size, tconv_dims[-1]]
+    """
+    assert upsample_mode in UPSAMPLE_MODES
+    feature_dim = fc.get_shape().as_list()[-1]
+    if upsample_mode == 'tconv':
+        up = tf.expand_dims(fc, axis=2)
+    else:
+        up = tf.reshape(fc, [batch_size, 1, feature_dim, 1])
 
     last_filter = 1
     for cnt, (up_size, up_filter) in enumerate(zip(tconv_dims, tconv_filters)):
         assert up_size%feature_dim == 0
         stride = up_size // feature_dim
         feature_dim = up_size
-        f = tf.Variable(tf.random_normal([3, up_filter, last_filter]))
-        up = conv1d_transpose(up, f, [batch_size, up_size, up_filter], stride, name='up{}'.format(cnt))
+        # the layer is called again when the gradients are built, so its arguments are bound now as defaults,
+        # recompute_grad inspects the code of the function and does not accept a functools.partial
+        def layer_fn(up, cnt=cnt, up_size=up_size, up_filter=up_filter, last_filter=last_filter, stride=stride):
+            return upsample_layer(up, cnt, batch_size, up_size, up_filter, last_filter, stride,
+                                  upsample_mode=upsample_mode, conv_up=conv_up, get_variable=gradient_checkpoint,
+                                  seed=seed)
+        if gradient_checkpoint:
+            # recompute_grad only passes gradients to resource variables
+            with tf.variable_scope('up_block{}'.format(cnt), use_resource=True):
+                up = tf.contrib.layers.recompute_grad(layer_fn)(up)
+        else:
+            up = layer_fn(up)
         last_filter = up_filter
 
-    up = tf.layers.conv1d(up, 1, 1, activation=None, name='conv_final')
-
-    return tf.squeeze(up, axis=2)
+    if upsample_mode == 'tconv':
+        up = tf.layers.conv1d(up, 1, 1, activation=None, name='conv_final',
+                              kernel_initializer=tf.glorot_uniform_initializer(seed=layer_seed(seed, 'conv_final')))
+        return tf.squeeze(up, axis=2)
+    else:
+        up = tf.layers.conv2d(up, 1, (1, 1), activation=None, name='conv_final',
+                              kernel_initializer=tf.glorot_uniform_initializer(seed=layer_seed(seed, 'conv_final')))
+        return tf.squeeze(up, axis=[1, 3])
 
 
-def my_model_fn_linear(features, batch_size, fc_filters, tconv_dims, tconv_filters):
+def my_model_fn(features, batch_size, fc_filters, tconv_dims, tconv_filters, upsample_mode='tconv',
+                gradient_checkpoint=False, seed=None):
     """
     My customized model function
     :param features: input features
     :param output_size: dimension of output data
+    :param upsample_mode: upsampling block to use, one of UPSAMPLE_MODES
+    :param gradient_checkpoint: if True, recompute activations of the upsampling layers in the backward pass
+    :param seed: random seed of the initialization, None for an unseeded initialization
     :return:
     """
     fc = features
     for cnt, filters in enumerate(fc_filters):
-        fc = linear(fc, filters, 'fc_linear_{}'.format(cnt), with_w=False)
-        fc = tf.nn.leaky_relu(fc)
-
-    up = tf.expand_dims(fc, axis=2)
-    feature_dim = fc_filters[-1]
-
-    last_filter = 1
-    for cnt, (up_size, up_filter) in enumerate(zip(tconv_dims, tconv_filters)):
-        assert up_size%feature_dim == 0
-        stride = up_size // feature_dim
-        feature_dim = up_size
-        f = tf.Variable(tf.random_normal([3, up_filter, last_filter]))
-        up = conv1d_transpose(up, f, [batch_size, up_size, up_filter], stride, name='up{}'.format(cnt))
-        last_filter = up_filter
-
-    up = tf.layers.conv1d(up, 1, 1, activation=None, name='conv_final')
+        fc = tf.layers.dense(inputs=fc, units=filters, activation=tf.nn.leaky_relu, name='fc{}'.format(cnt),
+                             kernel_initializer=tf.random_normal_initializer(
+                                 stddev=0.02, seed=layer_seed(seed, 'fc{}'.format(cnt))))
 
-    return tf.squeeze(up, axis=2)
+    return upsample_stack(fc, batch_size, tconv_dims, tconv_filters, upsample_mode,
+                          gradient_checkpoint=gradient_checkpoint, seed=seed)
 
 
-def my_model_fn_linear_conv1d(features, batch_size, fc_filters, tconv_dims, tconv_filters):
+def my_model_fn_linear(features, batch_size, fc_filters, tconv_dims, tconv_filters, upsample_mode='tconv',
+                       gradient_checkpoint=False, seed=None):
     """
     My customized model function
     :param features: input features
     :param output_size: dimension of output data
+    :param upsample_mode: upsampling block to use, one of UPSAMPLE_MODES
+    :param gradient_checkpoint: if True, recompute activations of the upsampling layers in the backward pass
+    :param seed: random seed of the initialization, None for an unseeded initialization
     :return:
     """
     fc = features
     for cnt, filters in enumerate(fc_filters):
-        fc = linear(fc, filters, 'fc_linear_{}'.format(cnt), with_w=False)
+        fc = linear(fc, filters, 'fc_linear_{}'.format(cnt), with_w=False,
+                    seed=layer_seed(seed, 'fc_linear_{}'.format(cnt)))
         fc = tf.nn.leaky_relu(fc)
 
-    up = tf.expand_dims(fc, axis=2)
-    feature_dim = fc_filters[-1]
+    return upsample_stack(fc, batch_size, tconv_dims, tconv_filters, upsample_mode,
+                          gradient_checkpoint=gradient_checkpoint, seed=seed)
 
-    last_filter = 1
-    for cnt, (up_size, up_filter) in enumerate(zip(tconv_dims, tconv_filters)):
-        assert up_size%feature_dim == 0
-        stride = up_size // feature_dim
-        feature_dim = up_size
-        f = tf.Variable(tf.random_normal([3, up_filter, last_filter]))
-        up = conv1d_transpose(up, f, [batch_size, up_size, up_filter], stride, name='up{}'.format(cnt))
-        up = tf.layers.conv1d(up, up_filter, 3, activation=tf.nn.leaky_relu, name='conv_up{}'.format(cnt),
-                              padding='same')
-        last_filter = up_filter
 
-    up = tf.layers.conv1d(up, 1, 1, activation=None, name='conv_final')
+def my_model_fn_linear_conv1d(features, batch_size, fc_filters, tconv_dims, tconv_filters, upsample_mode='tconv',
+                              gradient_checkpoint=False, seed=None):
+    """
+    My customized model function
+    :param features: input features
+    :param output_size: dimension of output data
+    :param upsample_mode: upsampling block to use, one of UPSAMPLE_MODES
+    :param gradient_checkpoint: if True, recompute activations of the upsampling layers in the backward pass
+    :param seed: random seed of the initialization, None for an unseeded initialization
+    :return:
+    """
+    fc = features
+    for cnt, filters in enumerate(fc_filters):
+        fc = linear(fc, filters, 'fc_linear_{}'.format(cnt), with_w=False,
+                    seed=layer_seed(seed, 'fc_linear_{}'.format(cnt)))
+        fc = tf.nn.leaky_relu(fc)
 
-    return tf.squeeze(up, axis=2)
+    return upsample_stack(fc, batch_size, tconv_dims, tconv_filters, upsample_mode, conv_up=True,
+                          gradient_checkpoint=gradient_checkpoint, seed=seed)